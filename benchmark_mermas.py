@@ -0,0 +1,180 @@
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+import psycopg2
+
+import insercionbasededatos as carga
+
+# Cardinalidades aproximadas de una exportación real
+CARDINALIDADES = {
+    'region': 16,
+    'comuna': 340,
+    'tienda': 450,
+    'zonal': 12,
+    'categoria': 40,
+    'motivo': 12,
+    'ubicacion_motivo': 4,
+    'dias': 365
+}
+
+def generar_mermas(filas, semilla=0):
+    """Genera un DataFrame sintético de mermas con las columnas y cardinalidades reales"""
+    rng = np.random.default_rng(semilla)
+    
+    # Cada tienda pertenece a una comuna, cada comuna a una región y a un zonal
+    comuna_region = rng.integers(0, CARDINALIDADES['region'], CARDINALIDADES['comuna'])
+    comuna_zonal = rng.integers(0, CARDINALIDADES['zonal'], CARDINALIDADES['comuna'])
+    tienda_comuna = rng.integers(0, CARDINALIDADES['comuna'], CARDINALIDADES['tienda'])
+    
+    # Pocos productos concentran la mayoría de las mermas
+    productos = max(100, min(50000, filas // 20))
+    producto_categoria = rng.integers(0, CARDINALIDADES['categoria'], productos)
+    
+    tienda = rng.integers(0, CARDINALIDADES['tienda'], filas)
+    comuna = tienda_comuna[tienda]
+    producto = np.minimum(rng.zipf(1.3, filas) - 1, productos - 1)
+    
+    regiones = np.array([f"Región {i + 1}" for i in range(CARDINALIDADES['region'])])
+    comunas = np.array([f"Comuna {i + 1}" for i in range(CARDINALIDADES['comuna'])])
+    categorias = np.array([f"Categoría {i + 1}" for i in range(CARDINALIDADES['categoria'])])
+    motivos = np.array([f"Motivo {i + 1}" for i in range(CARDINALIDADES['motivo'])])
+    ubicaciones_motivo = np.array(['Sala de venta', 'Bodega', 'Recepción', 'Transporte'])[:CARDINALIDADES['ubicacion_motivo']]
+    
+    return pd.DataFrame({
+        'codigo_producto': 100000 + producto,
+        'descripcion': np.char.add('Producto ', (100000 + producto).astype(str)),
+        'fecha': pd.Timestamp('2024-01-01') + pd.to_timedelta(rng.integers(0, CARDINALIDADES['dias'], filas), unit='D'),
+        'motivo': motivos[rng.integers(0, len(motivos), filas)],
+        'ubicacion_motivo': ubicaciones_motivo[rng.integers(0, len(ubicaciones_motivo), filas)],
+        'region': regiones[comuna_region[comuna]],
+        'comuna': comunas[comuna],
+        'tienda': np.char.add('Tienda ', tienda.astype(str)),
+        'zonal': np.char.add('Zonal ', comuna_zonal[comuna].astype(str)),
+        'categoria': categorias[producto_categoria[producto]],
+        'linea': np.char.add('Línea ', (producto_categoria[producto] % 8).astype(str)),
+        'seccion': np.char.add('Sección ', (producto_categoria[producto] % 4).astype(str)),
+        'negocio': np.where(producto_categoria[producto] < 20, 'Alimentos', 'No alimentos'),
+        'abastecimiento': np.where(producto % 3 == 0, 'Directo', 'Centro de distribución'),
+        'merma_unidad_p': rng.integers(1, 50, filas),
+        'merma_monto_p': rng.gamma(2.0, 4500.0, filas).round(2)
+    })
+
+def escribir_entrada(df, ruta):
+    """Escribe el archivo de entrada en Excel, CSV o Parquet según la extensión"""
+    if ruta.endswith('.csv'):
+        df.to_csv(ruta, index=False)
+    elif ruta.endswith('.parquet'):
+        df.to_parquet(ruta, index=False)
+    else:
+        df.to_excel(ruta, index=False)
+
+def ejecutar_caso(conn, ruta, filas, config):
+    """Mide cada etapa de la carga real (cargar_archivo) sobre un archivo y la deshace al terminar"""
+    print(f"\n=== {filas:,} filas ({os.path.basename(ruta)}) ===")
+    medidor = carga.MedidorCarga(ruta)
+    
+    try:
+        inicio = time.perf_counter()
+        carga.cargar_archivo(conn, ruta, config, medidor=medidor)
+        segundos = time.perf_counter() - inicio
+    finally:
+        # La base de datos de benchmark queda igual para el siguiente caso
+        conn.rollback()
+    
+    return {
+        'filas': filas,
+        'formato': os.path.splitext(ruta)[1].lstrip('.'),
+        'segundos_total': round(segundos, 4),
+        'filas_por_segundo_total': round(filas / segundos, 1),
+        'etapas': medidor.reporte()['etapas']
+    }
+
+def comparar(resultados, archivo_base, tolerancia):
+    """Compara filas por segundo contra un resultado anterior; devuelve las regresiones encontradas"""
+    with open(archivo_base, encoding='utf-8') as archivo:
+        base = {(caso['filas'], caso['formato']): caso for caso in json.load(archivo)['resultados']}
+    
+    regresiones = []
+    for caso in resultados:
+        anterior = base.get((caso['filas'], caso['formato']))
+        if not anterior:
+            continue
+        for etapa, medida in caso['etapas'].items():
+            previa = anterior['etapas'].get(etapa, {}).get('filas_por_segundo')
+            actual = medida['filas_por_segundo']
+            if previa and actual and actual < previa * (1 - tolerancia):
+                regresiones.append(f"{caso['filas']:,} filas, {etapa}: {previa:,.0f} -> {actual:,.0f} filas/s")
+    return regresiones
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark de la carga de mermas con datos sintéticos")
+    parser.add_argument('--filas', type=int, nargs='+', default=[10000, 100000, 1000000])
+    parser.add_argument('--formato', choices=['xlsx', 'csv', 'parquet'], default='csv')
+    parser.add_argument('--dsn', default=None, help="PostgreSQL desechable (por defecto DB_CONFIG)")
+    parser.add_argument('--motor', choices=['python', 'staging'], default=carga.CARGA_CONFIG['motor'])
+    parser.add_argument('--modo-mermas', choices=['copy', 'fila'], default=carga.CARGA_CONFIG['modo_mermas'])
+    parser.add_argument('--tipos-compactos', action='store_true', help="Esquema y DataFrame con tipos compactos")
+    parser.add_argument('--particionado', action='store_true', help="Mermas particionada por mes")
+    parser.add_argument('--salida', default='benchmark_resultados.json')
+    parser.add_argument('--comparar', default=None, help="Resultado anterior contra el que detectar regresiones")
+    parser.add_argument('--tolerancia', type=float, default=0.2)
+    args = parser.parse_args()
+    
+    # Cada caso lee y carga el archivo completo en una sola transacción, que luego se deshace
+    config = {**carga.CARGA_CONFIG, 'motor': args.motor, 'modo_mermas': args.modo_mermas,
+              'tipos_compactos': args.tipos_compactos, 'particionado': args.particionado,
+              'dir_cache': None, 'incremental': False, 'reanudable': False, 'dir_rechazos': None,
+              'reporte_json': None, 'reporte_prometheus': None}
+    
+    # Esquema propio y desechable para no tocar datos reales
+    esquema = f"benchmark_{os.getpid()}"
+    # Conexión instrumentada para contar las sentencias SQL de cada etapa
+    if args.dsn:
+        conn = psycopg2.connect(args.dsn, connection_factory=carga.ConexionInstrumentada)
+    else:
+        conn = psycopg2.connect(connection_factory=carga.ConexionInstrumentada, **carga.DB_CONFIG)
+    cursor = conn.cursor()
+    cursor.execute(f"CREATE SCHEMA {esquema}")
+    cursor.execute(f"SET search_path TO {esquema}")
+    conn.commit()
+    
+    resultados = []
+    try:
+        carga.crear_tablas(conn, args.particionado, compacto=args.tipos_compactos)
+        with tempfile.TemporaryDirectory() as directorio:
+            for filas in args.filas:
+                ruta = os.path.join(directorio, f"mermas_{filas}.{args.formato}")
+                escribir_entrada(generar_mermas(filas), ruta)
+                resultados.append(ejecutar_caso(conn, ruta, filas, config))
+    finally:
+        cursor.execute(f"DROP SCHEMA {esquema} CASCADE")
+        conn.commit()
+        conn.close()
+    
+    with open(args.salida, 'w', encoding='utf-8') as archivo:
+        json.dump({
+            'fecha': datetime.now().isoformat(timespec='seconds'),
+            'motor': args.motor,
+            'modo_mermas': args.modo_mermas,
+            'tipos_compactos': args.tipos_compactos,
+            'particionado': args.particionado,
+            'resultados': resultados
+        }, archivo, indent=2, ensure_ascii=False)
+    print(f"\nResultados guardados en {args.salida}")
+    
+    if args.comparar:
+        regresiones = comparar(resultados, args.comparar, args.tolerancia)
+        for regresion in regresiones:
+            print(f"REGRESIÓN: {regresion}")
+        if regresiones:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,27 @@
 
+import numpy as np
 import pandas as pd
 import psycopg2
+import psycopg2.extras
+import psycopg2.pool
 from datetime import datetime
+import asyncio
 import calendar
 import hashlib
+import glob
+import importlib.util
+import io
+import json
+import os
+import resource
+import sys
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
 import unicodedata
+from collections import OrderedDict
+from contextlib import ExitStack, contextmanager, nullcontext
+from functools import lru_cache
 
 # Configuración de la base de datos
 DB_CONFIG = {
@@ -15,10 +32,76 @@ DB_CONFIG = {
     'port': '5432'
 }
 
+# Configuración de la carga (cada clave puede sobrescribirse en procesar_excel)
+CARGA_CONFIG = {
+    'motor': 'python',          # 'python' (dimensiones resueltas en el cliente) o 'staging' (set-based en PostgreSQL)
+    'modo_mermas': 'copy',      # 'copy' (COPY FROM STDIN por lotes) o 'fila' (INSERT fila a fila)
+    'tamano_lote': 50000,       # Filas por lote enviado con COPY
+    'años_calendario': 2,       # Años completos de calendario que se dejan cargados por adelantado
+    'tamano_bloque': None,      # Filas por bloque al leer por streaming (None = leer el archivo completo)
+    'dir_cache': '.cache_mermas',   # Caché de archivos ya leídos y normalizados (None = desactivada)
+    'cache_max_mb': 500,        # Tamaño máximo de la caché
+    'cache_max_dias': 7,        # Antigüedad máxima de una entrada de la caché
+    'incremental': False,       # Saltar archivos ya cargados y cargar solo fechas nuevas o modificadas (lee el archivo completo)
+    'procesos_lectura': None,   # Procesos que leen archivos en paralelo (None = núcleos disponibles)
+    'conexiones_carga': 4,      # Conexiones (y cargas simultáneas) del pool de PostgreSQL
+    'reporte_json': None,       # Ruta del reporte de etapas en JSON (admite '{archivo}')
+    'reporte_prometheus': None, # Ruta del archivo textfile de Prometheus (admite '{archivo}')
+    'dir_rechazos': 'rechazos', # Directorio de las filas rechazadas por la validación (None = no guardar)
+    'formato_rechazos': 'csv',  # 'csv' o 'parquet'
+    'particionado': False,      # Crear Mermas particionada por mes (solo si la tabla aún no existe)
+    'reemplazar_meses': False,  # Con Mermas particionada, vaciar los meses del archivo antes de cargarlos (solo procesar_excel, sin incremental)
+    'resumenes': True,          # Refrescar las tablas resumen de los meses afectados por cada carga
+    'carga_masiva': None,       # Quitar índices y FKs de Mermas durante la carga (None = según carga_masiva_umbral)
+    'carga_masiva_umbral': 500000,  # Filas a partir de las cuales se usa la carga masiva automáticamente
+    'indice_fecha': 'btree',    # Tipo del índice de Mermas por fecha: 'btree' o 'brin' (compacto, para datos en orden)
+    'consultas_conexiones': 4,  # Conexiones del pool usado por las consultas de reporte
+    'consultas_cache_max': 256, # Resultados de consultas guardados en memoria (LRU)
+    'consultas_cache_ttl': 300, # Segundos que vive un resultado en la caché de consultas
+    'tipos_compactos': False,   # Tipos numéricos pequeños en el esquema nuevo e id_merma BIGINT; 'category' en memoria
+    'formato_entrada': None,    # 'excel', 'csv' o 'parquet' (None = según la extensión del archivo)
+    'motor_excel': None,        # Motor de pd.read_excel (None = 'calamine' si está instalado, si no 'openpyxl')
+    'solo_columnas_necesarias': True,  # Leer solo las columnas que usa la carga
+    'reanudable': False,        # Confirmar cada filas_por_commit filas y reanudar desde el último checkpoint
+    'filas_por_commit': 100000, # Filas por transacción en modo reanudable
+    'dimensiones_concurrentes': False, # procesar_excel: cargar las dimensiones en paralelo con conexiones propias
+    'pipeline': False,          # Leer, transformar y escribir bloques a la vez (asyncio con colas acotadas)
+    'profundidad_cola': 2,      # Bloques que pueden esperar entre dos etapas del pipeline
+    'perfil_muestra': 10000,    # Filas leídas por el perfil rápido del diagnóstico (None = todo el archivo, sin materializarlo)
+    'dir_espejo': None          # Directorio del espejo Parquet de Mermas por añomes, rehecho tras cada carga (None = desactivado)
+}
+
+# Versión del lector: cambiarla invalida las entradas de la caché de archivos leídos
+VERSION_LECTOR = 2
+
+
+class CursorInstrumentado(psycopg2.extensions.cursor):
+    """Cursor que cuenta las sentencias ejecutadas en su conexión"""
+    
+    def execute(self, query, vars=None):
+        self.connection.sentencias += 1
+        return super().execute(query, vars)
+    
+    def executemany(self, query, vars_list):
+        self.connection.sentencias += 1
+        return super().executemany(query, vars_list)
+    
+    def copy_expert(self, sql, file, size=8192):
+        self.connection.sentencias += 1
+        return super().copy_expert(sql, file, size)
+
+class ConexionInstrumentada(psycopg2.extensions.connection):
+    """Conexión que lleva la cuenta de las sentencias SQL ejecutadas"""
+    
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.sentencias = 0
+        self.cursor_factory = CursorInstrumentado
+
 def conectar_db():
     """Conecta a la base de datos PostgreSQL"""
     try:
-        conn = psycopg2.connect(**DB_CONFIG)
+        conn = psycopg2.connect(connection_factory=ConexionInstrumentada, **DB_CONFIG)
         return conn
     except Exception as e:
         print(f"Error conectando a la base de datos: {e}")
@@ -32,43 +115,312 @@ def normalizar_texto(texto):
     # Convertir a string si no lo es
     texto = str(texto)
     
-    # Remover tildes y normalizar
-    texto_normalizado = unicodedata.normalize('NFD', texto)
-    texto_sin_tildes = ''.join(c for c in texto_normalizado if unicodedata.category(c) != 'Mn')
+    return quitar_tildes(texto)
+
+@lru_cache(maxsize=100000)
+def quitar_tildes(texto):
+    """Remueve tildes de un texto (memoizado: cada texto distinto se procesa una sola vez)"""
+    if texto.isascii():
+        return texto
     
-    return texto_sin_tildes
+    texto_normalizado = unicodedata.normalize('NFD', texto)
+    return ''.join(c for c in texto_normalizado if unicodedata.category(c) != 'Mn')
 
-def normalizar_columnas(df):
-    """Normaliza los nombres de las columnas del DataFrame"""
-    columnas_normalizadas = {}
-    for col in df.columns:
-        col_normalizada = normalizar_texto(col)
-        columnas_normalizadas[col] = col_normalizada
+@lru_cache(maxsize=100000)
+def normalizar_valor(texto):
+    """Normaliza un valor de dimensión: sin tildes y con espacios simples"""
+    return ' '.join(quitar_tildes(texto).split())
+
+def normalizar_valores(serie):
+    """Normaliza una columna de texto procesando solo sus valores distintos"""
+    if isinstance(serie.dtype, pd.CategoricalDtype):
+        if len(serie.cat.categories) == 0:
+            return serie
+        # Se normalizan solo las categorías; las que coinciden al normalizar se fusionan
+        mapa, categorias = pd.factorize(np.array([normalizar_valor(str(valor)) for valor in serie.cat.categories], dtype=object))
+        codigos = serie.cat.codes.to_numpy()
+        codigos = np.where(codigos >= 0, mapa[codigos], -1)
+        return pd.Series(pd.Categorical.from_codes(codigos, categorias), index=serie.index, name=serie.name)
     
-    # Renombrar columnas
-    df_normalizado = df.rename(columns=columnas_normalizadas)
+    codigos, unicos = pd.factorize(serie)
+    if len(unicos) == 0:
+        return serie
+    
+    normalizados = np.array([normalizar_valor(str(valor)) for valor in unicos] + [None], dtype=object)
+    # Los nulos (código -1) toman el último elemento: None
+    return pd.Series(normalizados[codigos], index=serie.index, name=serie.name)
+
+def normalizar_encabezados(columnas):
+    """Normaliza una lista de nombres de columnas y muestra los cambios"""
+    columnas_normalizadas = {col: normalizar_texto(col) for col in columnas}
     
     print("=== NORMALIZACIÓN DE COLUMNAS ===")
     for original, normalizada in columnas_normalizadas.items():
         if original != normalizada:
             print(f"'{original}' -> '{normalizada}'")
     
-    return df_normalizado
+    return columnas_normalizadas
+
+def normalizar_columnas(df):
+    """Normaliza los nombres de las columnas del DataFrame"""
+    columnas_normalizadas = normalizar_encabezados(df.columns)
+    
+    # Renombrar columnas
+    return df.rename(columns=columnas_normalizadas)
+
+# Columnas de texto que identifican miembros de las dimensiones
+COLUMNAS_DIMENSION = ['region', 'comuna', 'tienda', 'zonal', 'categoria', 'motivo', 'ubicacion_motivo']
+
+def normalizar_dataframe(df):
+    """Deja el DataFrame leído listo para cargar
+    
+    Quita tildes de los nombres de columnas y de los valores de las columnas de
+    dimensión, para que 'Región Metropolitana' y 'Region Metropolitana' sean el mismo miembro.
+    """
+    columnas = {col: normalizar_texto(col) for col in df.columns}
+    if any(original != normalizada for original, normalizada in columnas.items()):
+        df = df.rename(columns=columnas)
+    
+    presentes = [col for col in COLUMNAS_DIMENSION if col in df.columns]
+    if presentes:
+        df = df.assign(**{col: normalizar_valores(df[col]) for col in presentes})
+    return df
+
+# Columnas de texto con pocos valores distintos, guardadas como 'category' en modo compacto
+COLUMNAS_CATEGORICAS = COLUMNAS_DIMENSION + ['descripcion', 'linea', 'seccion', 'negocio', 'abastecimiento']
+
+def compactar_dataframe(df):
+    """Reduce la memoria del DataFrame: texto repetido como 'category' y enteros con el tipo más pequeño
+    
+    Los montos no se reducen a float32 para no perder centavos.
+    """
+    cambios = {}
+    for col in df.columns:
+        serie = df[col]
+        if col in COLUMNAS_CATEGORICAS and not isinstance(serie.dtype, pd.CategoricalDtype):
+            if pd.api.types.is_object_dtype(serie) or pd.api.types.is_string_dtype(serie):
+                cambios[col] = serie.astype('category')
+        elif pd.api.types.is_integer_dtype(serie) and not pd.api.types.is_bool_dtype(serie):
+            cambios[col] = pd.to_numeric(serie, downcast='integer')
+    return df.assign(**cambios) if cambios else df
+
+def hash_archivo(ruta):
+    """Calcula el hash SHA-256 del contenido de un archivo"""
+    sha = hashlib.sha256()
+    with open(ruta, 'rb') as archivo:
+        for bloque in iter(lambda: archivo.read(1024 * 1024), b''):
+            sha.update(bloque)
+    return sha.hexdigest()
+
+def limpiar_cache(directorio, max_mb, max_dias):
+    """Elimina entradas de la caché más antiguas que max_dias o que excedan max_mb en total"""
+    if not os.path.isdir(directorio):
+        return
+    
+    ahora = time.time()
+    entradas = []
+    for nombre in os.listdir(directorio):
+        ruta = os.path.join(directorio, nombre)
+        if not nombre.endswith('.parquet') or not os.path.isfile(ruta):
+            continue
+        estado = os.stat(ruta)
+        if ahora - estado.st_mtime > max_dias * 86400:
+            os.remove(ruta)
+        else:
+            entradas.append((estado.st_mtime, estado.st_size, ruta))
+    
+    # Conservar las entradas usadas más recientemente mientras quepan en el límite
+    total = 0
+    for _, tamano, ruta in sorted(entradas, reverse=True):
+        total += tamano
+        if total > max_mb * 1024 * 1024:
+            os.remove(ruta)
+
+# Columnas del archivo de entrada que usa la carga (nombres ya normalizados)
+COLUMNAS_ENTRADA = ['codigo_producto', 'fecha', 'merma_unidad_p', 'merma_monto_p'] + COLUMNAS_CATEGORICAS
+
+def columnas_a_leer(encabezados, config):
+    """Encabezados originales que hay que leer: los que usa la carga, o todos"""
+    if not config['solo_columnas_necesarias']:
+        return list(encabezados)
+    return [col for col in encabezados if normalizar_texto(str(col)) in COLUMNAS_ENTRADA]
+
+def tipos_entrada(columnas, config):
+    """Tipos explícitos de las columnas de texto, para no inferirlos al leer"""
+    tipo = 'category' if config['tipos_compactos'] else str
+    return {col: tipo for col in columnas if normalizar_texto(str(col)) in COLUMNAS_CATEGORICAS}
+
+def motor_excel(config):
+    """Motor de lectura de Excel: el configurado, o calamine (mucho más rápido) si está instalado"""
+    if config['motor_excel']:
+        return config['motor_excel']
+    return 'calamine' if importlib.util.find_spec('python_calamine') else 'openpyxl'
+
+def leer_excel(ruta, config):
+    """Lee la primera hoja de un Excel"""
+    motor = motor_excel(config)
+    columnas = columnas_a_leer(pd.read_excel(ruta, engine=motor, nrows=0).columns, config)
+    return pd.read_excel(ruta, engine=motor, usecols=columnas, dtype=tipos_entrada(columnas, config))
+
+def leer_csv(ruta, config):
+    """Lee un CSV con el motor de pyarrow (multihilo) si está instalado"""
+    columnas = columnas_a_leer(pd.read_csv(ruta, nrows=0).columns, config)
+    motor = 'pyarrow' if importlib.util.find_spec('pyarrow') else 'c'
+    return pd.read_csv(ruta, engine=motor, usecols=columnas, dtype=tipos_entrada(columnas, config))
+
+def leer_parquet(ruta, config):
+    """Lee un Parquet con pyarrow, solo con las columnas necesarias"""
+    import pyarrow.parquet as pq
+    
+    columnas = columnas_a_leer(pq.read_schema(ruta).names, config)
+    return pd.read_parquet(ruta, columns=columnas)
+
+# Lector de cada formato de entrada
+LECTORES = {
+    'excel': leer_excel,
+    'csv': leer_csv,
+    'parquet': leer_parquet
+}
+
+# Sin '.xls': ni openpyxl (lectura por defecto y por bloques) ni el conteo de filas pueden leerlo
+EXTENSIONES = {'.xlsx': 'excel', '.xlsm': 'excel', '.csv': 'csv', '.parquet': 'parquet'}
+
+def formato_de(ruta, config):
+    """Formato de un archivo de entrada: el configurado o el que indica su extensión"""
+    formato = config['formato_entrada'] or EXTENSIONES.get(os.path.splitext(ruta)[1].lower())
+    if formato not in LECTORES:
+        raise ValueError(f"Formato de entrada no soportado: {ruta}")
+    return formato
+
+def leer_archivo(ruta, config=None):
+    """Lee un archivo de entrada de cualquier formato y normaliza sus columnas
+    
+    Los encabezados originales quedan en df.attrs['encabezados_originales'] (se guardan
+    también en la caché de Parquet, para el diagnóstico).
+    """
+    config = {**CARGA_CONFIG, **(config or {})}
+    df = LECTORES[formato_de(ruta, config)](ruta, config)
+    encabezados = [str(col) for col in df.columns]
+    df = normalizar_columnas(df)
+    df.attrs['encabezados_originales'] = encabezados
+    return compactar_dataframe(df) if config['tipos_compactos'] else df
+
+def seleccionar_columnas(df, config):
+    """Aplica a un DataFrame leído con todas sus columnas las opciones de lectura de la carga"""
+    if config['solo_columnas_necesarias']:
+        df = df[[col for col in df.columns if col in COLUMNAS_ENTRADA]]
+    return compactar_dataframe(df) if config['tipos_compactos'] else df
+
+def leer_excel_por_bloques(archivo_excel, tamano_bloque, compacto=False):
+    """Lee la primera hoja del Excel en bloques de filas con un iterador de solo lectura de openpyxl"""
+    import openpyxl
+    
+    libro = openpyxl.load_workbook(archivo_excel, read_only=True, data_only=True)
+    try:
+        filas = libro.worksheets[0].iter_rows(values_only=True)
+        encabezado = next(filas, None)
+        if encabezado is None:
+            return
+        
+        # Normalizar encabezados una sola vez
+        columnas = list(normalizar_encabezados(encabezado).values())
+        
+        # El índice de cada bloque sigue al del anterior: es la posición de la fila en la hoja
+        bloque = []
+        leidas = 0
+        for fila in filas:
+            bloque.append(fila)
+            if len(bloque) >= tamano_bloque:
+                df = pd.DataFrame.from_records(bloque, columns=columnas, index=pd.RangeIndex(leidas, leidas + len(bloque)))
+                yield compactar_dataframe(df) if compacto else df
+                leidas += len(bloque)
+                bloque = []
+        
+        if bloque:
+            df = pd.DataFrame.from_records(bloque, columns=columnas, index=pd.RangeIndex(leidas, leidas + len(bloque)))
+            yield compactar_dataframe(df) if compacto else df
+    finally:
+        libro.close()
+
+def leer_por_bloques(ruta, config):
+    """Lee un archivo de entrada en bloques de config['tamano_bloque'] filas, con columnas normalizadas"""
+    formato = formato_de(ruta, config)
+    tamano_bloque = config['tamano_bloque']
+    compacto = config['tipos_compactos']
+    
+    if formato == 'excel':
+        yield from leer_excel_por_bloques(ruta, tamano_bloque, compacto)
+        return
+    
+    if formato == 'csv':
+        columnas = columnas_a_leer(pd.read_csv(ruta, nrows=0).columns, config)
+        bloques = pd.read_csv(ruta, usecols=columnas, dtype=tipos_entrada(columnas, config), chunksize=tamano_bloque)
+    else:
+        import pyarrow.parquet as pq
+        
+        archivo = pq.ParquetFile(ruta)
+        columnas = columnas_a_leer(archivo.schema_arrow.names, config)
+        bloques = (lote.to_pandas() for lote in archivo.iter_batches(batch_size=tamano_bloque, columns=columnas))
+    
+    # Normalizar encabezados una sola vez
+    nombres = normalizar_encabezados(columnas)
+    leidas = 0
+    for df in bloques:
+        # Índice continuo entre bloques (los lotes de Parquet empiezan en 0): 'fila' de los rechazos
+        df = df.rename(columns=nombres).set_axis(pd.RangeIndex(leidas, leidas + len(df)))
+        leidas += len(df)
+        yield compactar_dataframe(df) if compacto else df
+
+def leer_archivo_cacheado(archivo_excel, config=None):
+    """Lee y normaliza el archivo, reutilizando la versión en Parquet de un Excel si el contenido no cambió
+    
+    CSV y Parquet se leen directamente: leerlos ya es tan rápido como leer la caché.
+    La caché guarda el Excel con todas sus columnas y sin compactar, así el diagnóstico
+    y la carga comparten una sola lectura; las opciones de la carga se aplican después.
+    """
+    config = {**CARGA_CONFIG, **(config or {})}
+    directorio = config['dir_cache']
+    
+    if not directorio or formato_de(archivo_excel, config) != 'excel':
+        return leer_archivo(archivo_excel, config)
+    
+    ruta_cache = os.path.join(directorio, f"{hash_archivo(archivo_excel)}-v{VERSION_LECTOR}.parquet")
+    
+    if os.path.exists(ruta_cache):
+        try:
+            df = pd.read_parquet(ruta_cache)
+            os.utime(ruta_cache)  # Marcar como usada recientemente
+            print(f"Archivo leído desde la caché: {ruta_cache}")
+            return seleccionar_columnas(df, config)
+        except Exception as e:
+            print(f"Advertencia: No se pudo leer la caché ({e}), se leerá el Excel")
+    
+    df = leer_archivo(archivo_excel, {**config, 'solo_columnas_necesarias': False, 'tipos_compactos': False})
+    
+    ruta_temporal = f"{ruta_cache}.{os.getpid()}.tmp"
+    try:
+        os.makedirs(directorio, exist_ok=True)
+        df.to_parquet(ruta_temporal, index=False)
+        os.replace(ruta_temporal, ruta_cache)
+        limpiar_cache(directorio, config['cache_max_mb'], config['cache_max_dias'])
+    except Exception as e:
+        print(f"Advertencia: No se pudo guardar el archivo en la caché: {e}")
+        if os.path.exists(ruta_temporal):
+            os.remove(ruta_temporal)
+    
+    return seleccionar_columnas(df, config)
 
 def diagnosticar_excel(archivo_excel):
     """Diagnostica el archivo Excel para ver sus columnas"""
     try:
-        df = pd.read_excel(archivo_excel)
+        df_normalizado = leer_archivo_cacheado(archivo_excel, {'solo_columnas_necesarias': False})
         print("=== DIAGNÓSTICO DEL ARCHIVO EXCEL ===")
-        print(f"Número de filas: {len(df)}")
-        print(f"Número de columnas: {len(df.columns)}")
+        print(f"Número de filas: {len(df_normalizado)}")
+        print(f"Número de columnas: {len(df_normalizado.columns)}")
         print("\nColumnas disponibles (originales):")
-        for i, col in enumerate(df.columns):
+        for i, col in enumerate(df_normalizado.attrs.get('encabezados_originales', df_normalizado.columns)):
             print(f"{i+1:2d}. {col}")
         
-        # Normalizar columnas
-        df_normalizado = normalizar_columnas(df)
-        
         print("\nColumnas después de normalización:")
         for i, col in enumerate(df_normalizado.columns):
             print(f"{i+1:2d}. {col}")
@@ -81,25 +433,193 @@ def diagnosticar_excel(archivo_excel):
         print(f"Error leyendo el archivo: {e}")
         return None
 
-def crear_tablas(conn):
-    """Crea todas las tablas necesarias si no existen"""
+# Columnas que necesita cada función de inserción
+COLUMNAS_REQUERIDAS = {
+    'insertar_ubicacion': ['region', 'comuna', 'tienda', 'zonal'],
+    'insertar_producto': ['codigo_producto', 'descripcion', 'categoria', 'linea', 'seccion', 'negocio', 'abastecimiento'],
+    'insertar_motivo_detalle': ['motivo', 'ubicacion_motivo'],
+    'insertar_mermas': ['codigo_producto', 'fecha', 'motivo', 'ubicacion_motivo', 'region', 'comuna', 'tienda', 'zonal']
+}
+
+class HyperLogLog:
+    """Estimador de valores distintos con memoria fija (2^precision registros de un byte)"""
+    
+    def __init__(self, precision=12):
+        self.precision = precision
+        self.registros = np.zeros(1 << precision, dtype=np.uint8)
+    
+    def agregar(self, serie):
+        """Agrega los valores no nulos de una serie"""
+        serie = serie.dropna()
+        if serie.empty:
+            return
+        hashes = pd.util.hash_pandas_object(serie.astype(str), index=False).to_numpy(dtype=np.uint64)
+        resto = 64 - self.precision
+        indices = (hashes >> np.uint64(resto)).astype(np.int64)
+        bits = hashes & np.uint64((1 << resto) - 1)
+        # Posición del primer bit en 1 dentro de los bits restantes
+        rangos = np.where(bits == 0, resto + 1, resto - np.floor(np.log2(np.maximum(bits, 1).astype(float))).astype(np.int64))
+        np.maximum.at(self.registros, indices, rangos.astype(np.uint8))
+    
+    def estimar(self):
+        """Cantidad estimada de valores distintos agregados"""
+        m = len(self.registros)
+        alfa = 0.7213 / (1 + 1.079 / m)
+        estimacion = alfa * m * m / np.sum(np.power(2.0, -self.registros.astype(float)))
+        ceros = int(np.count_nonzero(self.registros == 0))
+        if estimacion <= 2.5 * m and ceros:
+            # Corrección para pocos valores: conteo lineal
+            estimacion = m * np.log(m / ceros)
+        return int(round(estimacion))
+
+def perfilar_archivo(ruta, muestra=None, config=None):
+    """Perfil rápido del archivo en una sola pasada por bloques, sin materializar el DataFrame completo
+    
+    Con muestra se leen solo el encabezado y las primeras `muestra` filas. Devuelve filas,
+    y por columna la proporción de nulos y los valores distintos estimados; además el
+    rango de fechas y las columnas requeridas que faltan.
+    """
+    config = {**CARGA_CONFIG, **(config or {}), 'solo_columnas_necesarias': False, 'tipos_compactos': False}
+    config['tamano_bloque'] = min(muestra or 50000, 50000)
+    
+    filas = 0
+    nulos = {}
+    distintos = {}
+    fecha_min = fecha_max = None
+    bloques = leer_por_bloques(ruta, config)
+    try:
+        for df in bloques:
+            if muestra:
+                df = df.iloc[:muestra - filas]
+            df = normalizar_dataframe(df)
+            filas += len(df)
+            
+            for col in df.columns:
+                nulos[col] = nulos.get(col, 0) + int(df[col].isna().sum())
+                distintos.setdefault(col, HyperLogLog()).agregar(df[col])
+            
+            if 'fecha' in df.columns:
+                fechas = pd.to_datetime(df['fecha'], errors='coerce').dropna()
+                if not fechas.empty:
+                    fecha_min = min(filter(None, [fecha_min, fechas.min().date()]))
+                    fecha_max = max(filter(None, [fecha_max, fechas.max().date()]))
+            
+            if muestra and filas >= muestra:
+                break
+    finally:
+        bloques.close()
+    
+    return {
+        'archivo': ruta,
+        'filas': filas,
+        'muestra': bool(muestra),
+        'columnas': {col: {'nulos': round(nulos[col] / filas, 4) if filas else None,
+                           'distintos_estimados': distintos[col].estimar()}
+                     for col in nulos},
+        'fecha_min': fecha_min,
+        'fecha_max': fecha_max,
+        'faltantes': {funcion: [col for col in columnas if col not in nulos]
+                      for funcion, columnas in COLUMNAS_REQUERIDAS.items()
+                      if any(col not in nulos for col in columnas)}
+    }
+
+def imprimir_perfil(perfil):
+    """Muestra el perfil del archivo"""
+    print("=== PERFIL DEL ARCHIVO ===")
+    alcance = "muestra de las primeras filas" if perfil['muestra'] else "archivo completo"
+    print(f"Filas leídas: {perfil['filas']} ({alcance})")
+    print(f"Fechas: {perfil['fecha_min']} a {perfil['fecha_max']}")
+    
+    print(f"\n{'columna':<20} {'nulos':>8} {'distintos':>10}")
+    for col, datos in perfil['columnas'].items():
+        nulos = f"{datos['nulos']:.1%}" if datos['nulos'] is not None else '-'
+        print(f"{col:<20} {nulos:>8} {datos['distintos_estimados']:>10,}")
+    
+    if perfil['faltantes']:
+        print("\nColumnas requeridas faltantes:")
+        for funcion, columnas in perfil['faltantes'].items():
+            print(f"  {funcion}: {', '.join(columnas)}")
+    else:
+        print("\nEstán todas las columnas requeridas")
+
+# Tablas resumen para los dashboards: mermas agregadas por añomes y estas columnas
+RESUMENES = {
+    'resumen_mermas_tienda': ['nombre_region', 'tienda', 'nombre_categoria', 'motivo'],
+    'resumen_mermas_region': ['nombre_region', 'nombre_categoria']
+}
+
+# Expresión de cada columna de resumen sobre las dimensiones unidas a Mermas
+COLUMNAS_RESUMEN = {
+    'nombre_region': "COALESCE(u.nombre_region, '')",
+    'tienda': "COALESCE(u.tienda, '')",
+    'nombre_categoria': "COALESCE(c.nombre_categoria, '')",
+    'motivo': "COALESCE(md.motivo, '')"
+}
+
+def crear_tablas(conn, particionado=False, indice_fecha='btree', compacto=False):
+    """Crea todas las tablas necesarias si no existen
+    
+    Con particionado=True la tabla Mermas se crea particionada por rango de fecha
+    (una partición por mes, creadas con asegurar_particiones). indice_fecha elige
+    el tipo de idx_mermas_fecha: 'btree' o 'brin'. Con compacto=True las tablas
+    nuevas usan SMALLINT para los números de Tiempo, id_motivo INT e id_merma BIGINT.
+    """
     cursor = conn.cursor()
     
+    # Tipos de las columnas que cambian en el esquema compacto
+    if compacto:
+        tipos = {'numero': 'SMALLINT', 'texto': 'VARCHAR(20)', 'id_merma': 'BIGINT', 'id_motivo': 'INT'}
+    else:
+        tipos = {'numero': 'VARCHAR(255)', 'texto': 'VARCHAR(255)', 'id_merma': 'VARCHAR(255)', 'id_motivo': 'VARCHAR(255)'}
+    
+    if particionado:
+        # La clave primaria de una tabla particionada debe incluir la columna de partición
+        mermas_sql = f"""
+        CREATE TABLE IF NOT EXISTS mermas (
+            id_merma {tipos['id_merma']},
+            merma_unidad INT,
+            merma_monto DECIMAL(10,2),
+            id_motivo {tipos['id_motivo']},
+            codigo_producto INT,
+            fecha DATE,
+            id_comuna INT,
+            CONSTRAINT mermas_pkey PRIMARY KEY (id_merma, fecha),
+            FOREIGN KEY (codigo_producto) REFERENCES producto(codigo_producto),
+            FOREIGN KEY (fecha) REFERENCES tiempo(fecha),
+            FOREIGN KEY (id_comuna) REFERENCES ubicacion(id_ubicacion)
+        ) PARTITION BY RANGE (fecha)
+        """
+    else:
+        mermas_sql = f"""
+        CREATE TABLE IF NOT EXISTS mermas (
+            id_merma {tipos['id_merma']} PRIMARY KEY,
+            merma_unidad INT,
+            merma_monto DECIMAL(10,2),
+            id_motivo {tipos['id_motivo']},
+            codigo_producto INT,
+            fecha DATE,
+            id_comuna INT,
+            FOREIGN KEY (codigo_producto) REFERENCES producto(codigo_producto),
+            FOREIGN KEY (fecha) REFERENCES tiempo(fecha),
+            FOREIGN KEY (id_comuna) REFERENCES ubicacion(id_ubicacion)
+        )
+        """
+    
     # SQL para crear las tablas
     tablas_sql = [
-        """
+        f"""
         CREATE TABLE IF NOT EXISTS tiempo (
             fecha DATE PRIMARY KEY,
-            año VARCHAR(255),
+            año {tipos['numero']},
             añomes VARCHAR(255),
             añotrimestre VARCHAR(255),
             añodia VARCHAR(255),
-            dianum VARCHAR(255),
-            dia VARCHAR(255),
-            diasemananum VARCHAR(255),
-            semana VARCHAR(255),
-            mes VARCHAR(255),
-            mesnum VARCHAR(255),
+            dianum {tipos['numero']},
+            dia {tipos['texto']},
+            diasemananum {tipos['numero']},
+            semana {tipos['numero']},
+            mes {tipos['texto']},
+            mesnum {tipos['numero']},
             trimestre VARCHAR(255),
             semestre VARCHAR(255)
         )
@@ -140,25 +660,69 @@ def crear_tablas(conn):
             ubicacion_motivo VARCHAR(255)
         )
         """,
+        mermas_sql,
         """
-        CREATE TABLE IF NOT EXISTS mermas (
-            id_merma VARCHAR(255) PRIMARY KEY,
-            merma_unidad INT,
-            merma_monto DECIMAL(10,2),
-            id_motivo VARCHAR(255),
-            codigo_producto INT,
-            fecha DATE,
-            id_comuna INT,
-            FOREIGN KEY (codigo_producto) REFERENCES producto(codigo_producto),
-            FOREIGN KEY (fecha) REFERENCES tiempo(fecha),
-            FOREIGN KEY (id_comuna) REFERENCES ubicacion(id_ubicacion)
+        CREATE TABLE IF NOT EXISTS carga_manifiesto (
+            hash_archivo CHAR(64) PRIMARY KEY,
+            archivo VARCHAR(255),
+            filas INT,
+            fecha_min DATE,
+            fecha_max DATE,
+            cargado_en TIMESTAMP
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS carga_fechas (
+            fecha DATE PRIMARY KEY,
+            hash_contenido CHAR(16),
+            archivo VARCHAR(255)
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS carga_versiones (
+            mes DATE PRIMARY KEY,
+            version BIGINT,
+            actualizado_en TIMESTAMP
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS carga_checkpoint (
+            hash_archivo CHAR(64) PRIMARY KEY,
+            archivo VARCHAR(255),
+            bloques_confirmados INT,
+            filas_confirmadas BIGINT,
+            filas_por_bloque INT,
+            fecha_min DATE,
+            fecha_max DATE,
+            meses_vaciados TEXT,
+            actualizado_en TIMESTAMP
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS carga_masiva_pendiente (
+            nombre VARCHAR(255) PRIMARY KEY,
+            tipo VARCHAR(10),
+            definicion TEXT,
+            quitado_en TIMESTAMP
         )
         """
     ]
     
+    # Tablas resumen (las dimensiones sin valor quedan como '' para formar parte de la clave)
+    for tabla, columnas in RESUMENES.items():
+        tablas_sql.append(f"""
+        CREATE TABLE IF NOT EXISTS {tabla} (
+            añomes VARCHAR(255),
+            {''.join(f"{columna} VARCHAR(255),{chr(10)}            " for columna in columnas)}merma_unidad BIGINT,
+            merma_monto DECIMAL(14,2),
+            cantidad_mermas INT,
+            PRIMARY KEY (añomes, {', '.join(columnas)})
+        )
+        """)
+    
     # Crear índices
     indices_sql = [
-        "CREATE INDEX IF NOT EXISTS idx_mermas_fecha ON mermas(fecha)",
+        f"CREATE INDEX IF NOT EXISTS idx_mermas_fecha ON mermas USING {indice_fecha} (fecha)",
         "CREATE INDEX IF NOT EXISTS idx_mermas_producto ON mermas(codigo_producto)",
         "CREATE INDEX IF NOT EXISTS idx_mermas_ubicacion ON mermas(id_comuna)",
         "CREATE INDEX IF NOT EXISTS idx_producto_categoria ON producto(id_categoria)"
@@ -172,15 +736,35 @@ def crear_tablas(conn):
             cursor.execute(tabla_sql)
             tabla_nombre = tabla_sql.split('TABLE IF NOT EXISTS')[1].split('(')[0].strip()
             print(f"Tabla creada/verificada: {tabla_nombre}")
+        # Columna agregada a carga_checkpoint después de su primera versión
+        cursor.execute("ALTER TABLE carga_checkpoint ADD COLUMN IF NOT EXISTS filas_por_bloque INT")
         
-        # Crear índices
+        # Crear índices. Si otra carga masiva tiene el bloqueo, los de mermas faltan a
+        # propósito (esa carga los reconstruye) y crearlos aquí chocaría con sus inserciones
         print("Creando índices...")
+        cursor.execute("SELECT pg_try_advisory_xact_lock(hashtext('carga_masiva_mermas'))")
+        if cursor.fetchone()[0]:
+            cursor.execute("SELECT indexdef FROM pg_indexes WHERE indexname = 'idx_mermas_fecha' AND schemaname = current_schema()")
+            actual = cursor.fetchone()
+            if actual and f"USING {indice_fecha} " not in actual[0]:
+                print(f"Recreando idx_mermas_fecha como índice {indice_fecha}...")
+                cursor.execute("DROP INDEX idx_mermas_fecha")
+        else:
+            print("Hay una carga masiva en curso: se omiten los índices de mermas")
+            indices_sql = [sql for sql in indices_sql if ' ON mermas' not in sql]
         for indice_sql in indices_sql:
             cursor.execute(indice_sql)
         
         conn.commit()
         print("Todas las tablas e índices creados exitosamente!")
         
+        restaurar_carga_masiva(conn)
+        
+        if particionado and not mermas_particionada(conn):
+            print("Advertencia: La tabla 'mermas' ya existía sin particionar; se seguirá cargando sin particiones")
+        if compacto and not mermas_compacta(conn):
+            print("Advertencia: La tabla 'mermas' ya existía con tipos anteriores; se seguirá cargando con ellos")
+        
     except Exception as e:
         print(f"Error creando tablas: {e}")
         conn.rollback()
@@ -189,6 +773,368 @@ def crear_tablas(conn):
     finally:
         cursor.close()
 
+def mermas_particionada(conn):
+    """Indica si la tabla Mermas está particionada"""
+    cursor = conn.cursor()
+    try:
+        cursor.execute("""
+        SELECT EXISTS (
+            SELECT 1 FROM pg_partitioned_table p
+            JOIN pg_class c ON c.oid = p.partrelid
+            WHERE c.relname = 'mermas' AND pg_table_is_visible(c.oid)
+        )
+        """)
+        return cursor.fetchone()[0]
+    finally:
+        cursor.close()
+
+def mermas_compacta(conn):
+    """Indica si la tabla Mermas usa el esquema compacto (id_merma BIGINT)"""
+    cursor = conn.cursor()
+    try:
+        cursor.execute("""
+        SELECT data_type FROM information_schema.columns
+        WHERE table_schema = current_schema() AND table_name = 'mermas' AND column_name = 'id_merma'
+        """)
+        fila = cursor.fetchone()
+        return fila is not None and fila[0] == 'bigint'
+    finally:
+        cursor.close()
+
+def meses_en_rango(fecha_min, fecha_max):
+    """Primer día de cada mes entre dos fechas (inclusive)"""
+    return [mes.date() for mes in pd.date_range(pd.Timestamp(fecha_min).replace(day=1), fecha_max, freq='MS')]
+
+def nombre_particion(mes):
+    """Nombre de la partición mensual de Mermas"""
+    return f"mermas_{mes.year}_{mes.month:02d}"
+
+def asegurar_particiones(conn, fecha_min, fecha_max):
+    """Crea las particiones mensuales de Mermas que falten para un rango de fechas"""
+    cursor = conn.cursor()
+    try:
+        for mes in meses_en_rango(fecha_min, fecha_max):
+            siguiente = (pd.Timestamp(mes) + pd.offsets.MonthBegin(1)).date()
+            cursor.execute(f"""
+            CREATE TABLE IF NOT EXISTS {nombre_particion(mes)}
+            PARTITION OF mermas FOR VALUES FROM ('{mes}') TO ('{siguiente}')
+            """)
+    finally:
+        cursor.close()
+
+def vaciar_particiones(conn, meses):
+    """Vacía las particiones de los meses indicados (para reemplazar meses completos)"""
+    cursor = conn.cursor()
+    try:
+        for mes in meses:
+            cursor.execute(f"TRUNCATE {nombre_particion(mes)}")
+            print(f"Partición {nombre_particion(mes)} vaciada para recargar el mes")
+    finally:
+        cursor.close()
+
+def preparar_particiones(conn, df, meses_vaciados, reemplazar_meses):
+    """Crea las particiones del bloque y, si se pide, vacía los meses que aparecen por primera vez en la carga"""
+    fechas = pd.to_datetime(df['fecha'], errors='coerce').dropna()
+    if fechas.empty:
+        return
+    
+    asegurar_particiones(conn, fechas.min().date(), fechas.max().date())
+    
+    if reemplazar_meses:
+        meses = set(fechas.dt.to_period('M').dt.to_timestamp().dt.date) - meses_vaciados
+        vaciar_particiones(conn, sorted(meses))
+        meses_vaciados.update(meses)
+
+def refrescar_resumenes(conn, fecha_min, fecha_max):
+    """Recalcula las tablas resumen solo para los meses entre fecha_min y fecha_max
+    
+    Devuelve el total de filas de resumen escritas.
+    """
+    desde = pd.Timestamp(fecha_min).replace(day=1)
+    hasta = pd.Timestamp(fecha_max).replace(day=1) + pd.offsets.MonthBegin(1)
+    meses = (desde.strftime('%Y-%m'), pd.Timestamp(fecha_max).strftime('%Y-%m'))
+    
+    cursor = conn.cursor()
+    try:
+        # Las cargas simultáneas refrescan de a una para no pisarse los mismos meses
+        cursor.execute("SELECT pg_advisory_xact_lock(hashtext('resumenes_mermas'))")
+        
+        total = 0
+        for tabla, columnas in RESUMENES.items():
+            expresiones = ', '.join(COLUMNAS_RESUMEN[columna] for columna in columnas)
+            cursor.execute(f"DELETE FROM {tabla} WHERE añomes BETWEEN %s AND %s", meses)
+            cursor.execute(f"""
+            INSERT INTO {tabla} (añomes, {', '.join(columnas)}, merma_unidad, merma_monto, cantidad_mermas)
+            SELECT t.añomes, {expresiones}, SUM(m.merma_unidad), SUM(m.merma_monto), COUNT(*)
+            FROM mermas m
+            JOIN tiempo t ON t.fecha = m.fecha
+            LEFT JOIN ubicacion u ON u.id_ubicacion = m.id_comuna
+            LEFT JOIN producto p ON p.codigo_producto = m.codigo_producto
+            LEFT JOIN categoria c ON c.id_categoria = p.id_categoria
+            LEFT JOIN motivos_detalle md ON md.id_motivo = m.id_motivo::int
+            WHERE m.fecha >= %s AND m.fecha < %s
+            GROUP BY t.añomes, {expresiones}
+            """, (desde.date(), hasta.date()))
+            total += cursor.rowcount
+        
+        print(f"Resúmenes refrescados para {meses[0]} a {meses[1]}: {total} filas")
+        return total
+    finally:
+        cursor.close()
+
+def contar_filas(ruta, config):
+    """Filas de datos de un archivo de entrada sin leerlo completo (0 si no se pueden contar)"""
+    try:
+        formato = formato_de(ruta, config)
+        if formato == 'parquet':
+            import pyarrow.parquet as pq
+            return pq.ParquetFile(ruta).metadata.num_rows
+        
+        if formato == 'csv':
+            with open(ruta, 'rb') as archivo:
+                return max(sum(bloque.count(b'\n') for bloque in iter(lambda: archivo.read(1024 * 1024), b'')) - 1, 0)
+        
+        # Excel: dimensión guardada en la hoja
+        import openpyxl
+        libro = openpyxl.load_workbook(ruta, read_only=True)
+        try:
+            return max((libro.worksheets[0].max_row or 1) - 1, 0)
+        finally:
+            libro.close()
+    except Exception:
+        return 0
+
+def usar_carga_masiva(config, filas):
+    """Decide si la carga es lo bastante grande para quitar índices y FKs de Mermas"""
+    if config['carga_masiva'] is not None:
+        return config['carga_masiva']
+    return config['carga_masiva_umbral'] is not None and filas >= config['carga_masiva_umbral']
+
+def reconstruir_carga_masiva(conn):
+    """Vuelve a crear los índices y FKs de Mermas anotados en carga_masiva_pendiente
+    
+    Corre fuera de transacción: índices con CREATE INDEX CONCURRENTLY y FKs como
+    NOT VALID + VALIDATE (una sola pasada). Cada elemento se borra de la tabla apenas
+    queda reconstruido, y lo que ya existe no se vuelve a crear. Al final actualiza las
+    estadísticas con ANALYZE. Devuelve cuántos había.
+    """
+    particionada = mermas_particionada(conn)
+    cursor = conn.cursor()
+    try:
+        cursor.execute("SELECT nombre, tipo, definicion FROM carga_masiva_pendiente ORDER BY tipo = 'fk', nombre")
+        pendientes = cursor.fetchall()
+        for nombre, tipo, definicion in pendientes:
+            if tipo == 'indice':
+                # Un CREATE INDEX CONCURRENTLY interrumpido deja el índice inválido
+                cursor.execute("SELECT 1 FROM pg_index WHERE indexrelid = to_regclass(%s) AND NOT indisvalid", (nombre,))
+                if cursor.fetchone():
+                    cursor.execute(f"DROP INDEX {nombre}")
+                # Una tabla particionada no admite CONCURRENTLY sobre la tabla padre
+                opciones = 'INDEX IF NOT EXISTS' if particionada else 'INDEX CONCURRENTLY IF NOT EXISTS'
+                cursor.execute(definicion.replace('INDEX', opciones, 1))
+            else:
+                cursor.execute("SELECT 1 FROM pg_constraint WHERE conrelid = 'mermas'::regclass AND conname = %s", (nombre,))
+                if cursor.fetchone() is None:
+                    cursor.execute(f"ALTER TABLE mermas ADD CONSTRAINT {nombre} {definicion}{'' if particionada else ' NOT VALID'}")
+                if not particionada:
+                    cursor.execute(f"ALTER TABLE mermas VALIDATE CONSTRAINT {nombre}")
+            cursor.execute("DELETE FROM carga_masiva_pendiente WHERE nombre = %s", (nombre,))
+        
+        for tabla in ['mermas', 'tiempo'] + [dimension['tabla'] for dimension in DIMENSIONES.values()]:
+            cursor.execute(f"ANALYZE {tabla}")
+        return len(pendientes)
+    finally:
+        cursor.close()
+
+def restaurar_carga_masiva(conn):
+    """Reconstruye los índices y FKs de Mermas que dejó quitados una carga masiva interrumpida
+    
+    Si hay otra carga masiva en curso (tiene el bloqueo) sus índices faltan a propósito
+    y no se tocan. Un error se informa sin detener la carga.
+    """
+    conn.autocommit = True
+    cursor = conn.cursor()
+    try:
+        cursor.execute("SELECT pg_try_advisory_lock(hashtext('carga_masiva_mermas'))")
+        if not cursor.fetchone()[0]:
+            return
+        try:
+            cursor.execute("SELECT COUNT(*) FROM carga_masiva_pendiente")
+            pendientes = cursor.fetchone()[0]
+            if pendientes:
+                print(f"Restaurando {pendientes} índices y FKs de mermas quitados por una carga masiva interrumpida...")
+                reconstruir_carga_masiva(conn)
+        except Exception as e:
+            print(f"Advertencia: No se pudieron restaurar los índices y FKs de mermas: {e}")
+        finally:
+            cursor.execute("SELECT pg_advisory_unlock(hashtext('carga_masiva_mermas'))")
+    finally:
+        conn.autocommit = False
+        cursor.close()
+
+@contextmanager
+def carga_masiva(conn, activa=True):
+    """Quita los índices secundarios y las FKs de Mermas durante la carga y los reconstruye al final
+    
+    Las definiciones se guardan en carga_masiva_pendiente en la misma transacción que los
+    DROP, así una carga interrumpida no los pierde: crear_tablas los restaura en la
+    siguiente ejecución. Mientras dura la carga se tiene un bloqueo consultivo de sesión
+    (se libera solo si el proceso muere). Al salir, haya o no error, se reconstruyen con
+    reconstruir_carga_masiva y se actualizan las estadísticas con ANALYZE.
+    """
+    if not activa:
+        yield
+        return
+    
+    cursor = conn.cursor()
+    cursor.execute("SELECT pg_advisory_lock(hashtext('carga_masiva_mermas'))")
+    cursor.execute("""
+    SELECT c.relname, pg_get_indexdef(i.indexrelid)
+    FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid
+    WHERE i.indrelid = 'mermas'::regclass AND NOT i.indisprimary
+    """)
+    indices = cursor.fetchall()
+    cursor.execute("""
+    SELECT conname, pg_get_constraintdef(oid) FROM pg_constraint
+    WHERE conrelid = 'mermas'::regclass AND contype = 'f'
+    """)
+    foraneas = cursor.fetchall()
+    
+    print(f"Carga masiva: quitando {len(indices)} índices y {len(foraneas)} FKs de mermas...")
+    pendientes = [(nombre, 'indice', definicion) for nombre, definicion in indices]
+    pendientes += [(nombre, 'fk', definicion) for nombre, definicion in foraneas]
+    if pendientes:
+        psycopg2.extras.execute_values(cursor, """
+        INSERT INTO carga_masiva_pendiente (nombre, tipo, definicion, quitado_en)
+        VALUES %s
+        ON CONFLICT (nombre) DO NOTHING
+        """, pendientes, template="(%s, %s, %s, now())")
+    for nombre, _ in indices:
+        cursor.execute(f"DROP INDEX {nombre}")
+    for nombre, _ in foraneas:
+        cursor.execute(f"ALTER TABLE mermas DROP CONSTRAINT {nombre}")
+    conn.commit()
+    
+    try:
+        yield
+    finally:
+        conn.rollback()
+        conn.autocommit = True
+        try:
+            inicio = time.perf_counter()
+            reconstruir_carga_masiva(conn)
+            print(f"Carga masiva: índices y FKs reconstruidos en {time.perf_counter() - inicio:.1f}s")
+        finally:
+            cursor.execute("SELECT pg_advisory_unlock(hashtext('carga_masiva_mermas'))")
+            conn.autocommit = False
+            cursor.close()
+
+# Dimensiones con clave natural: columnas en la tabla y columnas equivalentes en el DataFrame
+DIMENSIONES = {
+    'ubicacion': {
+        'tabla': 'ubicacion',
+        'id': 'id_ubicacion',
+        'columnas_tabla': ['nombre_region', 'nombre_comuna', 'tienda', 'zonal'],
+        'columnas_df': ['region', 'comuna', 'tienda', 'zonal']
+    },
+    'categoria': {
+        'tabla': 'categoria',
+        'id': 'id_categoria',
+        'columnas_tabla': ['nombre_categoria'],
+        'columnas_df': ['categoria']
+    },
+    'producto': {
+        'tabla': 'producto',
+        'id': 'codigo_producto',
+        'columnas_tabla': ['codigo_producto'],
+        'columnas_df': ['codigo_producto']
+    },
+    'motivo': {
+        'tabla': 'motivos_detalle',
+        'id': 'id_motivo',
+        'columnas_tabla': ['motivo', 'ubicacion_motivo'],
+        'columnas_df': ['motivo', 'ubicacion_motivo']
+    }
+}
+
+class CacheDimensiones:
+    """Mapas clave natural -> ID de cada dimensión, cargados una sola vez por ejecución"""
+    
+    def __init__(self):
+        self.mapas = {}
+        self.no_resueltas = {nombre: 0 for nombre in DIMENSIONES}
+    
+    def cargar(self, conn):
+        """Lee cada dimensión completa desde la base de datos (una consulta por tabla)
+        
+        Las claves se normalizan como las del archivo (normalizar_dataframe), así los
+        miembros guardados antes con tildes ('Región Metropolitana') conservan su ID.
+        Si dos miembros quedan con la misma clave se usa el de menor ID.
+        """
+        cursor = conn.cursor()
+        try:
+            for nombre, dim in DIMENSIONES.items():
+                cursor.execute(f"SELECT {', '.join(dim['columnas_tabla'])}, {dim['id']} FROM {dim['tabla']} ORDER BY {dim['id']}")
+                mapa = pd.DataFrame(cursor.fetchall(), columns=dim['columnas_df'] + ['_id'])
+                presentes = [col for col in dim['columnas_df'] if col in COLUMNAS_DIMENSION]
+                if presentes and len(mapa):
+                    mapa = mapa.assign(**{col: normalizar_valores(mapa[col]) for col in presentes})
+                self.mapas[nombre] = self._normalizar_mapa(nombre, mapa)
+        finally:
+            cursor.close()
+    
+    def _normalizar_mapa(self, nombre, mapa):
+        """Deja las claves como texto y sin duplicados para poder hacer merges"""
+        columnas = DIMENSIONES[nombre]['columnas_df']
+        mapa = mapa.dropna(subset=columnas).astype({col: str for col in columnas})
+        return mapa.drop_duplicates(columnas).reset_index(drop=True)
+    
+    def _claves(self, nombre, df):
+        """Claves naturales del DataFrame como texto, conservando el índice original"""
+        return df[DIMENSIONES[nombre]['columnas_df']].astype(str)
+    
+    def resolver(self, nombre, df):
+        """Devuelve los IDs de la dimensión para cada fila del DataFrame (merge vectorizado)"""
+        columnas = DIMENSIONES[nombre]['columnas_df']
+        claves = self._claves(nombre, df)
+        
+        ids = claves.merge(self.mapas[nombre], on=columnas, how='left')['_id']
+        ids = pd.Series(ids.to_numpy(), index=df.index).astype('Int64')
+        
+        # Filas con clave completa que no existe en la dimensión
+        completas = df[columnas].notna().all(axis=1)
+        self.no_resueltas[nombre] += int((completas & ids.isna()).sum())
+        
+        return ids
+    
+    def nuevas(self, nombre, df):
+        """Filas del DataFrame cuya clave natural aún no existe en la dimensión"""
+        columnas = DIMENSIONES[nombre]['columnas_df']
+        claves = self._claves(nombre, df)
+        
+        existentes = claves.merge(self.mapas[nombre][columnas], on=columnas, how='left', indicator=True)
+        return df[existentes['_merge'].to_numpy() == 'left_only']
+    
+    def agregar(self, nombre, df, ids):
+        """Registra filas recién insertadas en la dimensión"""
+        columnas = DIMENSIONES[nombre]['columnas_df']
+        nuevas = df[columnas].copy()
+        nuevas['_id'] = list(ids)
+        self.mapas[nombre] = self._normalizar_mapa(nombre, pd.concat([self.mapas[nombre], nuevas], ignore_index=True))
+    
+    def reportar(self):
+        """Muestra las claves que no pudieron resolverse durante la carga"""
+        for nombre, cantidad in self.no_resueltas.items():
+            if cantidad:
+                print(f"Advertencia: {cantidad} filas con {nombre} no encontrada en la dimensión")
+
+def obtener_cache(conn, cache=None):
+    """Devuelve la caché recibida o crea y carga una nueva"""
+    if cache is None:
+        cache = CacheDimensiones()
+        cache.cargar(conn)
+    return cache
+
 def calcular_datos_tiempo(fecha):
     """Calcula todos los campos de tiempo basado en una fecha"""
     if pd.isna(fecha):
@@ -241,16 +1187,12 @@ def insertar_tiempo(conn, fecha_data):
     cursor = conn.cursor()
     
     try:
-        # Verificar si ya existe
-        cursor.execute("SELECT fecha FROM tiempo WHERE fecha = %s", (fecha_data['fecha'],))
-        if cursor.fetchone():
-            return
-        
-        # Insertar
+        # Insertar (si la fecha ya existe no se hace nada)
         query = """
         INSERT INTO tiempo (fecha, año, añomes, añotrimestre, añodia, dianum, dia, 
                            diasemananum, semana, mes, mesnum, trimestre, semestre)
         VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+        ON CONFLICT (fecha) DO NOTHING
         """
         
         valores = (
@@ -267,7 +1209,143 @@ def insertar_tiempo(conn, fecha_data):
     finally:
         cursor.close()
 
-def insertar_ubicacion(conn, ubicaciones_df):
+COLUMNAS_TIEMPO = ['fecha', 'año', 'añomes', 'añotrimestre', 'añodia', 'dianum', 'dia',
+                   'diasemananum', 'semana', 'mes', 'mesnum', 'trimestre', 'semestre']
+
+def construir_calendario(fecha_inicio, fecha_fin):
+    """Calcula los campos de tiempo de todos los días de un rango de forma vectorizada"""
+    fechas = pd.date_range(pd.Timestamp(fecha_inicio).normalize(), pd.Timestamp(fecha_fin).normalize(), freq='D')
+    
+    año = fechas.year.astype(str).to_numpy()
+    mes = fechas.month.to_numpy()
+    trimestre = (mes - 1) // 3 + 1
+    
+    calendario = pd.DataFrame({
+        'fecha': fechas.date,
+        'año': año,
+        'añomes': fechas.strftime('%Y-%m').to_numpy(),
+        'añotrimestre': año + '-Q' + trimestre.astype(str),
+        'añodia': fechas.strftime('%Y-%j').to_numpy(),
+        'dianum': fechas.day.astype(str).to_numpy(),
+        'dia': fechas.strftime('%A').to_numpy(),
+        'diasemananum': (fechas.dayofweek + 1).astype(str).to_numpy(),
+        'semana': fechas.isocalendar()['week'].astype(str).to_numpy(),
+        'mes': fechas.strftime('%B').to_numpy(),
+        'mesnum': mes.astype(str),
+        'trimestre': 'Q' + trimestre.astype(str),
+        'semestre': np.where(mes <= 6, 'S1', 'S2')
+    })
+    
+    return calendario[COLUMNAS_TIEMPO]
+
+def insertar_calendario(conn, fecha_inicio, fecha_fin):
+    """Inserta en una sola sentencia todos los días del rango que aún no existen en Tiempo"""
+    calendario = construir_calendario(fecha_inicio, fecha_fin)
+    if calendario.empty:
+        return 0
+    
+    cursor = conn.cursor()
+    try:
+        query = f"""
+        INSERT INTO tiempo ({', '.join(COLUMNAS_TIEMPO)})
+        VALUES %s
+        ON CONFLICT (fecha) DO NOTHING
+        """
+        psycopg2.extras.execute_values(
+            cursor, query, calendario.itertuples(index=False, name=None), page_size=len(calendario)
+        )
+        return cursor.rowcount
+    finally:
+        cursor.close()
+
+def tiempo_cubierto(conn, fecha_inicio, fecha_fin):
+    """Indica si la tabla Tiempo ya tiene todos los días del rango"""
+    cursor = conn.cursor()
+    try:
+        cursor.execute("SELECT COUNT(*) FROM tiempo WHERE fecha BETWEEN %s AND %s", (fecha_inicio, fecha_fin))
+        return cursor.fetchone()[0] == (fecha_fin - fecha_inicio).days + 1
+    finally:
+        cursor.close()
+
+def prepoblar_tiempo(conn, años_adelante=2, desde=None):
+    """Carga el calendario desde una fecha (por defecto el 1 de enero del año actual) hasta fin de año + N años"""
+    inicio = pd.Timestamp(desde) if desde is not None else pd.Timestamp(datetime.now().year, 1, 1)
+    fin = pd.Timestamp(inicio.year + años_adelante, 12, 31)
+    insertadas = insertar_calendario(conn, inicio, fin)
+    print(f"Calendario cargado hasta {fin.date()}: {insertadas} días nuevos")
+    return insertadas
+
+def cargar_tiempo(conn, df, años_adelante=0):
+    """Completa la tabla Tiempo para el rango de fechas del DataFrame (incluyendo días sin datos)"""
+    fechas = pd.to_datetime(df['fecha'], errors='coerce').dropna()
+    if fechas.empty:
+        return 0
+    
+    fecha_inicio = fechas.min().date()
+    fecha_fin = fechas.max().date()
+    
+    # Si el calendario ya está cargado no se escribe nada
+    if tiempo_cubierto(conn, fecha_inicio, fecha_fin):
+        return 0
+    
+    if años_adelante:
+        fecha_fin = max(fecha_fin, pd.Timestamp(fecha_fin.year + años_adelante, 12, 31).date())
+    
+    return insertar_calendario(conn, fecha_inicio, fecha_fin)
+
+def digest_clave(texto, bytes_digest=8):
+    """Digest BLAKE2 estable (igual en todos los procesos y ejecuciones) de una clave natural"""
+    return hashlib.blake2b(texto.encode('utf-8'), digest_size=bytes_digest).digest()
+
+def clave_natural(df, columnas):
+    """Une las columnas de la clave natural en un texto normalizado por fila"""
+    # Con pandas 3 astype(str) conserva los nulos: se dejan como texto vacío
+    partes = [df[col].astype(str).fillna('').str.strip() for col in columnas]
+    clave = partes[0]
+    for parte in partes[1:]:
+        clave = clave + '\x1f' + parte
+    return clave
+
+def generar_clave_entera(df, columnas, bits=31):
+    """Genera un ID entero estable para cada fila, calculado una vez por clave natural distinta"""
+    claves = clave_natural(df, columnas)
+    mascara = (1 << bits) - 1
+    ids = {clave: int.from_bytes(digest_clave(clave), 'big') & mascara for clave in claves.unique()}
+    return claves.map(ids)
+
+def verificar_id_existente(cursor, nombre, id_, valores):
+    """Comprueba que el miembro que ya tiene un ID generado sea el de la clave natural
+    
+    Los IDs son un digest de 31 bits: si dos claves naturales distintas chocan se
+    detiene la carga en lugar de asociar los hechos al miembro equivocado.
+    """
+    dim = DIMENSIONES[nombre]
+    cursor.execute(f"SELECT {', '.join(dim['columnas_tabla'])} FROM {dim['tabla']} WHERE {dim['id']} = %s", (id_,))
+    existente = cursor.fetchone()
+    if existente is not None and [str(v).strip() for v in existente] != [str(v).strip() for v in valores]:
+        raise ValueError(f"Colisión de IDs en {dim['tabla']}: el ID {id_} ya pertenece a {tuple(existente)}, "
+                         f"no se puede usar para {tuple(valores)}")
+
+def generar_id_ubicacion(df):
+    """Genera el ID de ubicación (INT) a partir de región, comuna, tienda y zonal"""
+    return generar_clave_entera(df, DIMENSIONES['ubicacion']['columnas_df'])
+
+def generar_id_merma(df, codigo, fecha, entero=False):
+    """Genera el ID de merma a partir del producto, la fecha, el motivo y la ubicación de cada fila
+    
+    Con entero=True devuelve un BIGINT estable derivado del mismo ID de texto (esquema compacto).
+    """
+    claves = clave_natural(df, ['motivo', 'ubicacion_motivo', 'region', 'comuna', 'tienda', 'zonal'])
+    sufijos = {clave: digest_clave(clave).hex() for clave in claves.unique()}
+    fecha = pd.to_datetime(fecha).dt.strftime('%Y-%m-%d')
+    ids = (codigo.astype(str) + '-' + pd.Series(fecha.to_numpy(), index=claves.index) + '-' +
+           claves.map(sufijos))
+    if entero:
+        mascara = (1 << 63) - 1
+        ids = ids.map(lambda id_merma: int.from_bytes(digest_clave(id_merma), 'big') & mascara).astype('int64')
+    return ids
+
+def insertar_ubicacion(conn, ubicaciones_df, cache=None):
     """Inserta datos únicos en la tabla Ubicacion"""
     cursor = conn.cursor()
     
@@ -280,31 +1358,30 @@ def insertar_ubicacion(conn, ubicaciones_df):
         cursor.close()
         return
     
-    # Obtener ubicaciones únicas
-    ubicaciones_unicas = ubicaciones_df[columnas_requeridas].drop_duplicates()
+    cache = obtener_cache(conn, cache)
+    
+    # Obtener ubicaciones únicas (sin valores nulos) que aún no existen
+    ubicaciones_unicas = ubicaciones_df[columnas_requeridas].dropna().drop_duplicates()
+    ubicaciones_nuevas = cache.nuevas('ubicacion', ubicaciones_unicas)
+    
+    insertadas = []
+    # Generar ID único (hash de los datos), insertando en orden de ID para que cargas
+    # concurrentes tomen los bloqueos en el mismo orden
+    ids_ubicacion = generar_id_ubicacion(ubicaciones_nuevas).sort_values()
+    ubicaciones_nuevas = ubicaciones_nuevas.loc[ids_ubicacion.index]
     
-    for _, row in ubicaciones_unicas.iterrows():
+    for (_, row), id_ubicacion in zip(ubicaciones_nuevas.iterrows(), ids_ubicacion):
         try:
-            # Verificar que no haya valores nulos
-            if any(pd.isna(val) for val in row):
-                continue
-                
-            # Generar ID único (hash de los datos)
-            id_ubicacion = abs(hash(f"{row['region']}-{row['comuna']}-{row['tienda']}-{row['zonal']}")) % 1000000
-            
-            # Verificar si ya existe
-            cursor.execute("SELECT id_ubicacion FROM ubicacion WHERE id_ubicacion = %s", (id_ubicacion,))
-            if cursor.fetchone():
-                continue
-            
             # Insertar
             query = """
             INSERT INTO ubicacion (id_ubicacion, nombre_region, codigo_region, nombre_comuna, tienda, zonal)
             VALUES (%s, %s, %s, %s, %s, %s)
+            ON CONFLICT (id_ubicacion) DO NOTHING
+            RETURNING id_ubicacion
             """
             
             valores = (
-                id_ubicacion,
+                int(id_ubicacion),
                 str(row['region']),
                 str(row['region'])[:3].upper(),  # Código de región (primeras 3 letras)
                 str(row['comuna']),
@@ -313,13 +1390,23 @@ def insertar_ubicacion(conn, ubicaciones_df):
             )
             
             cursor.execute(query, valores)
+            insertada = cursor.fetchone() is not None
         except Exception as e:
             print(f"Error insertando ubicación: {e}")
             continue
+        
+        # El ID es estable: si ya existía (o lo insertó otra carga) debe ser la misma ubicación
+        if not insertada:
+            verificar_id_existente(cursor, 'ubicacion', int(id_ubicacion), [row[col] for col in columnas_requeridas])
+        insertadas.append((row, int(id_ubicacion)))
+    
+    if insertadas:
+        cache.agregar('ubicacion', pd.DataFrame([row for row, _ in insertadas]), [id_ for _, id_ in insertadas])
     
     cursor.close()
+    return len(insertadas)
 
-def insertar_categoria(conn, categorias_df):
+def insertar_categoria(conn, categorias_df, cache=None):
     """Inserta datos únicos en la tabla Categoria"""
     cursor = conn.cursor()
     
@@ -329,30 +1416,42 @@ def insertar_categoria(conn, categorias_df):
         cursor.close()
         return
     
-    # Obtener categorías únicas
-    categorias_unicas = categorias_df['categoria'].dropna().unique()
+    cache = obtener_cache(conn, cache)
+    
+    # Obtener categorías únicas que aún no existen
+    categorias_unicas = categorias_df[['categoria']].dropna().drop_duplicates()
+    categorias_nuevas = cache.nuevas('categoria', categorias_unicas)
     
-    for i, categoria in enumerate(categorias_unicas, 1):
+    ids_categoria = generar_clave_entera(categorias_nuevas, ['categoria']).sort_values()
+    categorias_nuevas = categorias_nuevas.loc[ids_categoria.index]
+    insertadas = []
+    for categoria, id_categoria in zip(categorias_nuevas['categoria'], ids_categoria):
         try:
-            # Verificar si ya existe
-            cursor.execute("SELECT id_categoria FROM categoria WHERE nombre_categoria = %s", (str(categoria),))
-            if cursor.fetchone():
-                continue
-            
             # Insertar
             query = """
             INSERT INTO categoria (id_categoria, nombre_categoria, descripcion)
             VALUES (%s, %s, %s)
+            ON CONFLICT (id_categoria) DO NOTHING
+            RETURNING id_categoria
             """
             
-            cursor.execute(query, (i, str(categoria), f"Categoría {categoria}"))
+            cursor.execute(query, (int(id_categoria), str(categoria), f"Categoría {categoria}"))
+            insertada = cursor.fetchone() is not None
         except Exception as e:
             print(f"Error insertando categoría {categoria}: {e}")
             continue
+        
+        if not insertada:
+            verificar_id_existente(cursor, 'categoria', int(id_categoria), [categoria])
+        insertadas.append((categoria, int(id_categoria)))
+    
+    if insertadas:
+        cache.agregar('categoria', pd.DataFrame({'categoria': [c for c, _ in insertadas]}), [i for _, i in insertadas])
     
     cursor.close()
+    return len(insertadas)
 
-def insertar_producto(conn, productos_df):
+def insertar_producto(conn, productos_df, cache=None):
     """Inserta datos únicos en la tabla Producto"""
     cursor = conn.cursor()
     
@@ -365,35 +1464,32 @@ def insertar_producto(conn, productos_df):
         cursor.close()
         return
     
-    # Obtener productos únicos
-    productos_unicos = productos_df[columnas_requeridas].drop_duplicates()
+    cache = obtener_cache(conn, cache)
+    
+    # Obtener productos únicos (sin nulos críticos) que aún no existen
+    productos_unicos = productos_df[columnas_requeridas].dropna(subset=['codigo_producto', 'descripcion'])
+    productos_unicos = productos_unicos.drop_duplicates('codigo_producto')
+    productos_unicos['codigo_producto'] = pd.to_numeric(productos_unicos['codigo_producto'], errors='coerce').astype('Int64')
+    productos_nuevos = cache.nuevas('producto', productos_unicos.dropna(subset=['codigo_producto']))
+    productos_nuevos = productos_nuevos.sort_values('codigo_producto')
+    
+    # Obtener ID de categoría de todos los productos en una sola operación
+    ids_categoria = cache.resolver('categoria', productos_nuevos)
     
-    for _, row in productos_unicos.iterrows():
+    insertados = []
+    for (_, row), id_categoria in zip(productos_nuevos.iterrows(), ids_categoria):
         try:
-            # Verificar que no haya valores nulos críticos
-            if pd.isna(row['codigo_producto']) or pd.isna(row['descripcion']):
-                continue
-                
-            # Verificar si ya existe
-            cursor.execute("SELECT codigo_producto FROM producto WHERE codigo_producto = %s", (int(row['codigo_producto']),))
-            if cursor.fetchone():
-                continue
-            
-            # Obtener ID de categoría
-            cursor.execute("SELECT id_categoria FROM categoria WHERE nombre_categoria = %s", (str(row['categoria']) if pd.notna(row['categoria']) else '',))
-            categoria_result = cursor.fetchone()
-            id_categoria = categoria_result[0] if categoria_result else None
-            
             # Insertar
             query = """
             INSERT INTO producto (codigo_producto, nombre_producto, id_categoria, linea, seccion, negocio, abastecimiento)
             VALUES (%s, %s, %s, %s, %s, %s, %s)
+            ON CONFLICT (codigo_producto) DO NOTHING
             """
             
             valores = (
                 int(row['codigo_producto']),
                 str(row['descripcion']),
-                id_categoria,
+                None if pd.isna(id_categoria) else int(id_categoria),
                 str(row['linea']) if pd.notna(row['linea']) else '',
                 str(row['seccion']) if pd.notna(row['seccion']) else '',
                 str(row['negocio']) if pd.notna(row['negocio']) else '',
@@ -401,13 +1497,18 @@ def insertar_producto(conn, productos_df):
             )
             
             cursor.execute(query, valores)
+            insertados.append(int(row['codigo_producto']))
         except Exception as e:
             print(f"Error insertando producto {row['codigo_producto']}: {e}")
             continue
     
+    if insertados:
+        cache.agregar('producto', pd.DataFrame({'codigo_producto': insertados}), insertados)
+    
     cursor.close()
+    return len(insertados)
 
-def insertar_motivo_detalle(conn, motivos_df):
+def insertar_motivo_detalle(conn, motivos_df, cache=None):
     """Inserta datos únicos en la tabla Motivos_Detalle"""
     cursor = conn.cursor()
     
@@ -420,31 +1521,53 @@ def insertar_motivo_detalle(conn, motivos_df):
         cursor.close()
         return
     
-    # Obtener motivos únicos
+    cache = obtener_cache(conn, cache)
+    
+    # Obtener motivos únicos que aún no existen
     motivos_unicos = motivos_df[columnas_requeridas].dropna().drop_duplicates()
+    motivos_nuevos = cache.nuevas('motivo', motivos_unicos)
     
-    for i, (_, row) in enumerate(motivos_unicos.iterrows(), 1):
+    ids_motivo = generar_clave_entera(motivos_nuevos, columnas_requeridas).sort_values()
+    motivos_nuevos = motivos_nuevos.loc[ids_motivo.index]
+    insertados = []
+    for (_, row), id_motivo in zip(motivos_nuevos.iterrows(), ids_motivo):
         try:
-            # Verificar si ya existe
-            cursor.execute("SELECT id_motivo FROM motivos_detalle WHERE motivo = %s AND ubicacion_motivo = %s", 
-                          (str(row['motivo']), str(row['ubicacion_motivo'])))
-            if cursor.fetchone():
-                continue
-            
             # Insertar
             query = """
             INSERT INTO motivos_detalle (id_motivo, motivo, ubicacion_motivo)
             VALUES (%s, %s, %s)
+            ON CONFLICT (id_motivo) DO NOTHING
+            RETURNING id_motivo
             """
             
-            cursor.execute(query, (i, str(row['motivo']), str(row['ubicacion_motivo'])))
+            cursor.execute(query, (int(id_motivo), str(row['motivo']), str(row['ubicacion_motivo'])))
+            insertado = cursor.fetchone() is not None
         except Exception as e:
             print(f"Error insertando motivo {row['motivo']}: {e}")
             continue
+        
+        if not insertado:
+            verificar_id_existente(cursor, 'motivo', int(id_motivo), [row[col] for col in columnas_requeridas])
+        insertados.append((row, int(id_motivo)))
+    
+    if insertados:
+        cache.agregar('motivo', pd.DataFrame([row for row, _ in insertados]), [i for _, i in insertados])
     
     cursor.close()
+    return len(insertados)
+
+# Upsert de la tabla de hechos: solo escribe si la fila es nueva o cambió
+CONFLICTO_MERMAS = """
+ON CONFLICT ON CONSTRAINT mermas_pkey DO UPDATE SET
+    merma_unidad = EXCLUDED.merma_unidad,
+    merma_monto = EXCLUDED.merma_monto,
+    id_motivo = EXCLUDED.id_motivo,
+    id_comuna = EXCLUDED.id_comuna
+WHERE (mermas.merma_unidad, mermas.merma_monto, mermas.id_motivo, mermas.id_comuna)
+      IS DISTINCT FROM (EXCLUDED.merma_unidad, EXCLUDED.merma_monto, EXCLUDED.id_motivo, EXCLUDED.id_comuna)
+"""
 
-def insertar_mermas(conn, df):
+def insertar_mermas(conn, df, cache=None):
     """Inserta datos en la tabla Mermas"""
     cursor = conn.cursor()
     
@@ -464,38 +1587,36 @@ def insertar_mermas(conn, df):
         if col not in df.columns:
             print(f"Advertencia: Columna opcional '{col}' no encontrada, se usará 0 como valor por defecto")
     
+    # Obtener IDs de motivo y ubicación para todas las filas de una vez
+    cache = obtener_cache(conn, cache)
+    ids_motivo = cache.resolver('motivo', df)
+    ids_comuna = cache.resolver('ubicacion', df)
+    
+    # Generar ID único para merma en las filas con valores críticos válidos
+    codigo = pd.to_numeric(df['codigo_producto'], errors='coerce')
+    fecha = pd.to_datetime(df['fecha'], errors='coerce')
+    validas = (codigo.notna() & fecha.notna() &
+               df['motivo'].notna() & df['ubicacion_motivo'].notna())
+    entero = mermas_compacta(conn)
+    ids_merma = pd.Series(None, index=df.index, dtype=object)
+    if validas.any():
+        ids_merma[validas] = generar_id_merma(df[validas], codigo[validas].astype('int64'), fecha[validas], entero)
+    
     filas_procesadas = 0
     filas_saltadas = 0
+    vistos = set()
     
-    for _, row in df.iterrows():
+    for (_, row), id_merma, id_motivo, id_comuna in zip(df.iterrows(), ids_merma, ids_motivo, ids_comuna):
         try:
             # Verificar que los valores críticos no sean nulos
-            if (pd.isna(row['codigo_producto']) or pd.isna(row['fecha']) or 
-                pd.isna(row['motivo']) or pd.isna(row['ubicacion_motivo'])):
+            if pd.isna(id_merma):
                 filas_saltadas += 1
                 continue
             
-            # Generar ID único para merma
-            id_merma = f"{int(row['codigo_producto'])}-{row['fecha']}-{abs(hash(str(row['motivo']) + str(row['ubicacion_motivo']))) % 10000}"
-            
-            # Verificar si ya existe
-            cursor.execute("SELECT id_merma FROM mermas WHERE id_merma = %s", (id_merma,))
-            if cursor.fetchone():
+            # Un mismo ID solo se inserta una vez por archivo
+            if id_merma in vistos:
                 continue
-            
-            # Obtener ID de motivo
-            cursor.execute("SELECT id_motivo FROM motivos_detalle WHERE motivo = %s AND ubicacion_motivo = %s", 
-                          (str(row['motivo']), str(row['ubicacion_motivo'])))
-            motivo_result = cursor.fetchone()
-            id_motivo = str(motivo_result[0]) if motivo_result else None
-            
-            # Obtener ID de ubicación
-            cursor.execute("""
-            SELECT id_ubicacion FROM ubicacion 
-            WHERE nombre_region = %s AND nombre_comuna = %s AND tienda = %s AND zonal = %s
-            """, (str(row['region']), str(row['comuna']), str(row['tienda']), str(row['zonal'])))
-            ubicacion_result = cursor.fetchone()
-            id_comuna = ubicacion_result[0] if ubicacion_result else None
+            vistos.add(id_merma)
             
             # Obtener valores de merma (con valores por defecto si no existen)
             merma_unidad = 0
@@ -511,20 +1632,20 @@ def insertar_mermas(conn, df):
             query = """
             INSERT INTO mermas (id_merma, merma_unidad, merma_monto, id_motivo, codigo_producto, fecha, id_comuna)
             VALUES (%s, %s, %s, %s, %s, %s, %s)
-            """
+            """ + CONFLICTO_MERMAS
             
             valores = (
-                id_merma,
+                int(id_merma) if entero else id_merma,
                 merma_unidad,
                 merma_monto,
-                id_motivo,
+                None if pd.isna(id_motivo) else str(id_motivo),
                 int(row['codigo_producto']),
                 pd.to_datetime(row['fecha']).date(),
-                id_comuna
+                None if pd.isna(id_comuna) else int(id_comuna)
             )
             
             cursor.execute(query, valores)
-            filas_procesadas += 1
+            filas_procesadas += cursor.rowcount
             
         except Exception as e:
             print(f"Error insertando merma en fila {filas_procesadas + filas_saltadas}: {e}")
@@ -533,61 +1654,1227 @@ def insertar_mermas(conn, df):
     
     print(f"Mermas procesadas: {filas_procesadas}, Filas saltadas: {filas_saltadas}")
     cursor.close()
+    return filas_procesadas
 
-def procesar_excel(archivo_excel):
-    """Función principal para procesar el archivo Excel"""
+def copiar_dataframe(cursor, df, tabla, columnas):
+    """Envía las columnas indicadas del DataFrame a una tabla usando COPY FROM STDIN"""
+    buffer = io.StringIO()
+    df.to_csv(buffer, columns=columnas, index=False, header=False)
+    buffer.seek(0)
+    
+    cursor.copy_expert(
+        f"COPY {tabla} ({', '.join(columnas)}) FROM STDIN WITH (FORMAT csv)",
+        buffer
+    )
+
+def preparar_hechos_mermas(conn, df, cache=None):
+    """Construye en memoria las filas de la tabla Mermas a partir del DataFrame completo"""
+    cache = obtener_cache(conn, cache)
+    
+    # Filas con valores críticos válidos
+    codigo = pd.to_numeric(df['codigo_producto'], errors='coerce')
+    fecha = pd.to_datetime(df['fecha'], errors='coerce')
+    validas = (codigo.notna() & fecha.notna() &
+               df['motivo'].notna() & df['ubicacion_motivo'].notna())
+    filas_saltadas = int((~validas).sum())
+    
+    codigo = codigo[validas].astype('int64').reset_index(drop=True)
+    fecha = fecha[validas].reset_index(drop=True)
+    
+    hechos = pd.DataFrame({
+        'id_merma': generar_id_merma(df.loc[validas].reset_index(drop=True), codigo, fecha, mermas_compacta(conn)),
+        'merma_unidad': 0,
+        'merma_monto': 0.0,
+        'codigo_producto': codigo,
+        'fecha': fecha.dt.date
+    })
+    
+    # Obtener valores de merma (con valores por defecto si no existen)
+    if 'merma_unidad_p' in df.columns:
+        unidades = pd.to_numeric(df.loc[validas, 'merma_unidad_p'], errors='coerce')
+        hechos['merma_unidad'] = unidades.fillna(0).astype('int64').to_numpy()
+    if 'merma_monto_p' in df.columns:
+        montos = pd.to_numeric(df.loc[validas, 'merma_monto_p'], errors='coerce')
+        hechos['merma_monto'] = montos.fillna(0.0).astype(float).to_numpy()
+    
+    # Resolver IDs de motivo y ubicación con merges en lugar de consultas por fila
+    hechos['id_motivo'] = cache.resolver('motivo', df.loc[validas]).to_numpy()
+    hechos['id_comuna'] = cache.resolver('ubicacion', df.loc[validas]).to_numpy()
+    
+    # Un mismo ID solo se inserta una vez (igual que la verificación fila a fila)
+    hechos = hechos.drop_duplicates('id_merma')
+    
+    return hechos, filas_saltadas
+
+def insertar_mermas_copy(conn, df, tamano_lote=50000, cache=None):
+    """Inserta datos en la tabla Mermas con COPY FROM STDIN por lotes"""
+    # Verificar que las columnas existan
+    columnas_requeridas = ['codigo_producto', 'fecha', 'motivo', 'ubicacion_motivo', 'region', 'comuna', 'tienda', 'zonal']
+    columnas_faltantes = [col for col in columnas_requeridas if col not in df.columns]
+    
+    if columnas_faltantes:
+        print(f"Error: Columnas requeridas faltantes: {columnas_faltantes}")
+        return
+    
+    for col in ['merma_unidad_p', 'merma_monto_p']:
+        if col not in df.columns:
+            print(f"Advertencia: Columna opcional '{col}' no encontrada, se usará 0 como valor por defecto")
+    
+    inicio = time.perf_counter()
+    hechos, filas_saltadas = preparar_hechos_mermas(conn, df, cache)
+    
+    columnas = ['id_merma', 'merma_unidad', 'merma_monto', 'id_motivo', 'codigo_producto', 'fecha', 'id_comuna']
+    filas_procesadas = 0
+    
+    cursor = conn.cursor()
     try:
-        # Leer Excel
-        print("Leyendo archivo Excel...")
-        df_original = pd.read_excel(archivo_excel)
+        # Tabla temporal de carga: COPY no admite ON CONFLICT, así que se pasa por ella
+        cursor.execute("CREATE TEMP TABLE IF NOT EXISTS mermas_carga (LIKE mermas INCLUDING DEFAULTS)")
+        cursor.execute("TRUNCATE mermas_carga")
+        
+        for desde in range(0, len(hechos), tamano_lote):
+            lote = hechos.iloc[desde:desde + tamano_lote]
+            copiar_dataframe(cursor, lote, 'mermas_carga', columnas)
+            
+            cursor.execute(f"""
+            INSERT INTO mermas ({', '.join(columnas)})
+            SELECT {', '.join(columnas)} FROM mermas_carga
+            """ + CONFLICTO_MERMAS)
+            filas_procesadas += cursor.rowcount
+            cursor.execute("TRUNCATE mermas_carga")
+    finally:
+        cursor.close()
+    
+    duracion = time.perf_counter() - inicio
+    filas_por_segundo = len(hechos) / duracion if duracion > 0 else 0
+    print(f"Mermas procesadas: {filas_procesadas}, Filas saltadas: {filas_saltadas}")
+    print(f"Carga COPY: {len(hechos)} filas en {duracion:.2f}s ({filas_por_segundo:,.0f} filas/s)")
+    
+    return filas_procesadas
+
+# Columnas de la tabla de staging (filas crudas ya normalizadas)
+COLUMNAS_STAGING = {
+    'fila': 'BIGINT',
+    'codigo_producto': 'BIGINT',
+    'descripcion': 'TEXT',
+    'categoria': 'TEXT',
+    'linea': 'TEXT',
+    'seccion': 'TEXT',
+    'negocio': 'TEXT',
+    'abastecimiento': 'TEXT',
+    'fecha': 'DATE',
+    'motivo': 'TEXT',
+    'ubicacion_motivo': 'TEXT',
+    'region': 'TEXT',
+    'comuna': 'TEXT',
+    'tienda': 'TEXT',
+    'zonal': 'TEXT',
+    'merma_unidad': 'INT',
+    'merma_monto': 'NUMERIC(10,2)',
+    'id_ubicacion': 'INT',
+    'id_categoria': 'INT',
+    'id_motivo': 'INT',
+    'id_merma': 'VARCHAR(255)'
+}
+
+# Sentencias set-based que llenan el modelo desde la tabla de staging ({staging} = nombre de la tabla)
+SQL_STAGING = [
+    ('tiempo', """
+    INSERT INTO tiempo (fecha, año, añomes, añotrimestre, añodia, dianum, dia,
+                        diasemananum, semana, mes, mesnum, trimestre, semestre)
+    SELECT d::date,
+           EXTRACT(YEAR FROM d)::int,
+           to_char(d, 'YYYY-MM'),
+           to_char(d, 'YYYY') || '-Q' || to_char(d, 'Q'),
+           to_char(d, 'YYYY-DDD'),
+           EXTRACT(DAY FROM d)::int,
+           to_char(d, 'FMDay'),
+           EXTRACT(ISODOW FROM d)::int,
+           EXTRACT(WEEK FROM d)::int,
+           to_char(d, 'FMMonth'),
+           EXTRACT(MONTH FROM d)::int,
+           'Q' || to_char(d, 'Q'),
+           CASE WHEN EXTRACT(MONTH FROM d) <= 6 THEN 'S1' ELSE 'S2' END
+    FROM (SELECT MIN(fecha) AS desde, MAX(fecha) AS hasta FROM {staging}) r,
+         generate_series(r.desde, r.hasta, interval '1 day') AS d
+    ON CONFLICT (fecha) DO NOTHING
+    """),
+    ('ubicacion', """
+    INSERT INTO ubicacion (id_ubicacion, nombre_region, codigo_region, nombre_comuna, tienda, zonal)
+    SELECT DISTINCT ON (s.id_ubicacion) s.id_ubicacion, s.region, upper(left(s.region, 3)), s.comuna, s.tienda, s.zonal
+    FROM {staging} s
+    WHERE s.id_ubicacion IS NOT NULL
+      AND NOT EXISTS (SELECT 1 FROM ubicacion u
+                      WHERE u.nombre_region = s.region AND u.nombre_comuna = s.comuna
+                        AND u.tienda = s.tienda AND u.zonal = s.zonal)
+    ORDER BY s.id_ubicacion, s.fila
+    ON CONFLICT (id_ubicacion) DO NOTHING
+    """),
+    ('categoria', """
+    INSERT INTO categoria (id_categoria, nombre_categoria, descripcion)
+    SELECT DISTINCT ON (s.id_categoria) s.id_categoria, s.categoria, 'Categoría ' || s.categoria
+    FROM {staging} s
+    WHERE s.id_categoria IS NOT NULL
+      AND NOT EXISTS (SELECT 1 FROM categoria c WHERE c.nombre_categoria = s.categoria)
+    ORDER BY s.id_categoria, s.fila
+    ON CONFLICT (id_categoria) DO NOTHING
+    """),
+    ('producto', """
+    INSERT INTO producto (codigo_producto, nombre_producto, id_categoria, linea, seccion, negocio, abastecimiento)
+    SELECT DISTINCT ON (s.codigo_producto)
+           s.codigo_producto, s.descripcion, c.id_categoria,
+           COALESCE(s.linea, ''), COALESCE(s.seccion, ''), COALESCE(s.negocio, ''), COALESCE(s.abastecimiento, '')
+    FROM {staging} s
+    LEFT JOIN categoria c ON c.nombre_categoria = s.categoria
+    WHERE s.codigo_producto IS NOT NULL AND s.descripcion IS NOT NULL
+    ORDER BY s.codigo_producto, s.fila, c.id_categoria
+    ON CONFLICT (codigo_producto) DO NOTHING
+    """),
+    ('motivos_detalle', """
+    INSERT INTO motivos_detalle (id_motivo, motivo, ubicacion_motivo)
+    SELECT DISTINCT ON (s.id_motivo) s.id_motivo, s.motivo, s.ubicacion_motivo
+    FROM {staging} s
+    WHERE s.id_motivo IS NOT NULL
+      AND NOT EXISTS (SELECT 1 FROM motivos_detalle md
+                      WHERE md.motivo = s.motivo AND md.ubicacion_motivo = s.ubicacion_motivo)
+    ORDER BY s.id_motivo, s.fila
+    ON CONFLICT (id_motivo) DO NOTHING
+    """),
+    ('mermas', """
+    INSERT INTO mermas (id_merma, merma_unidad, merma_monto, id_motivo, codigo_producto, fecha, id_comuna)
+    SELECT DISTINCT ON (s.id_merma)
+           s.id_merma, s.merma_unidad, s.merma_monto, m.id_motivo, s.codigo_producto, s.fecha, u.id_ubicacion
+    FROM {staging} s
+    JOIN producto p ON p.codigo_producto = s.codigo_producto
+    JOIN LATERAL (SELECT MIN(id_motivo) AS id_motivo FROM motivos_detalle md
+                  WHERE md.motivo = s.motivo AND md.ubicacion_motivo = s.ubicacion_motivo) m ON m.id_motivo IS NOT NULL
+    JOIN LATERAL (SELECT MIN(id_ubicacion) AS id_ubicacion FROM ubicacion ub
+                  WHERE ub.nombre_region = s.region AND ub.nombre_comuna = s.comuna
+                    AND ub.tienda = s.tienda AND ub.zonal = s.zonal) u ON u.id_ubicacion IS NOT NULL
+    WHERE s.id_merma IS NOT NULL
+    ORDER BY s.id_merma, s.fila
+    """ + CONFLICTO_MERMAS)
+]
+
+def preparar_staging(df, entero=False):
+    """Arma las filas crudas de la tabla de staging (tipos convertidos e IDs calculados)"""
+    staging = pd.DataFrame(index=df.index)
+    
+    for col in COLUMNAS_STAGING:
+        if col in df.columns:
+            staging[col] = df[col]
+        else:
+            staging[col] = None
+    
+    staging['fila'] = np.arange(len(df))
+    staging['codigo_producto'] = pd.to_numeric(staging['codigo_producto'], errors='coerce').astype('Int64')
+    fecha = pd.to_datetime(staging['fecha'], errors='coerce')
+    staging['fecha'] = fecha.dt.date
+    
+    # Obtener valores de merma (con valores por defecto si no existen)
+    staging['merma_unidad'] = 0
+    staging['merma_monto'] = 0.0
+    if 'merma_unidad_p' in df.columns:
+        staging['merma_unidad'] = pd.to_numeric(df['merma_unidad_p'], errors='coerce').fillna(0).astype('int64')
+    if 'merma_monto_p' in df.columns:
+        staging['merma_monto'] = pd.to_numeric(df['merma_monto_p'], errors='coerce').fillna(0.0).astype(float)
+    
+    # IDs estables calculados en el cliente, iguales a los de la carga fila a fila
+    ubicacion_completa = staging[['region', 'comuna', 'tienda', 'zonal']].notna().all(axis=1)
+    staging['id_ubicacion'] = generar_id_ubicacion(staging).where(ubicacion_completa).astype('Int64')
+    staging['id_categoria'] = generar_clave_entera(staging, ['categoria']).where(staging['categoria'].notna()).astype('Int64')
+    motivo_completo = staging[['motivo', 'ubicacion_motivo']].notna().all(axis=1)
+    staging['id_motivo'] = generar_clave_entera(staging, ['motivo', 'ubicacion_motivo']).where(motivo_completo).astype('Int64')
+    
+    merma_valida = (staging['codigo_producto'].notna() & fecha.notna() &
+                    staging['motivo'].notna() & staging['ubicacion_motivo'].notna())
+    staging['id_merma'] = None
+    if merma_valida.any():
+        validas = staging[merma_valida]
+        staging.loc[merma_valida, 'id_merma'] = generar_id_merma(
+            validas, validas['codigo_producto'].astype('int64'), fecha[merma_valida], entero
+        )
+    
+    return staging
+
+def alinear_claves_guardadas(cursor, staging):
+    """Usa en staging la escritura guardada de los miembros anteriores a la normalización
+    
+    SQL_STAGING compara las claves naturales tal cual: así un miembro guardado como
+    'Región Metropolitana' se reconoce (con su ID) en lugar de crearse otro
+    'Region Metropolitana'. Si dos miembros quedan con la misma clave se usa el de menor ID,
+    como en CacheDimensiones.
+    """
+    for nombre in ('ubicacion', 'categoria', 'motivo'):
+        dim = DIMENSIONES[nombre]
+        columnas = dim['columnas_df']
+        cursor.execute(f"SELECT {', '.join(dim['columnas_tabla'])} FROM {dim['tabla']} ORDER BY {dim['id']}")
+        guardadas = pd.DataFrame(cursor.fetchall(), columns=columnas).dropna().astype(str)
+        if guardadas.empty:
+            continue
+        normalizadas = guardadas.assign(**{col: normalizar_valores(guardadas[col]) for col in columnas})
+        mapa = normalizadas.assign(**{f"{col}_guardada": guardadas[col] for col in columnas})
+        mapa = mapa.drop_duplicates(columnas)
+        mapa = mapa[(mapa[columnas].to_numpy() != mapa[[f"{col}_guardada" for col in columnas]].to_numpy()).any(axis=1)]
+        if mapa.empty:
+            continue
         
-        # Normalizar nombres de columnas (quitar tildes)
-        df = normalizar_columnas(df_original)
+        unidas = staging[columnas].astype(object).merge(mapa, on=columnas, how='left')
+        cambiar = unidas[f"{columnas[0]}_guardada"].notna().to_numpy()
+        if cambiar.any():
+            for col in columnas:
+                staging[col] = staging[col].astype(object)
+                staging.loc[cambiar, col] = unidas.loc[cambiar, f"{col}_guardada"].to_numpy()
+
+def verificar_ids_staging(cursor, tabla):
+    """Detiene la carga si un ID calculado en staging ya pertenece a otro miembro
+    
+    Es la verificación de verificar_id_existente para el motor staging, donde el
+    ON CONFLICT (id) DO NOTHING descartaría en silencio al miembro nuevo.
+    """
+    for nombre in ('ubicacion', 'categoria', 'motivo'):
+        dim = DIMENSIONES[nombre]
+        pares = list(zip(dim['columnas_tabla'], dim['columnas_df']))
+        misma_clave = ' AND '.join(f"{{alias}}.{col_tabla} = s.{col_df}" for col_tabla, col_df in pares)
+        cursor.execute(f"""
+        SELECT s.{dim['id']}, {', '.join(f"d.{col_tabla}" for col_tabla, _ in pares)},
+               {', '.join(f"s.{col_df}" for _, col_df in pares)}
+        FROM {tabla} s JOIN {dim['tabla']} d ON d.{dim['id']} = s.{dim['id']}
+        WHERE NOT ({misma_clave.format(alias='d')})
+          AND NOT EXISTS (SELECT 1 FROM {dim['tabla']} x WHERE {misma_clave.format(alias='x')})
+        LIMIT 1
+        """)
+        choque = cursor.fetchone()
+        if choque is not None:
+            n = len(pares)
+            raise ValueError(f"Colisión de IDs en {dim['tabla']}: el ID {choque[0]} ya pertenece a "
+                             f"{tuple(choque[1:n + 1])}, no se puede usar para {tuple(choque[n + 1:])}")
+
+def cargar_via_staging(conn, df, rechazos=None):
+    """Carga el DataFrame con COPY a una tabla UNLOGGED y llena el modelo con sentencias set-based
+    
+    Los hechos cuyo producto, ubicación o motivo no existe no llegan a Mermas y se agregan
+    a rechazos con el mismo código que en el motor python.
+    """
+    rechazos = rechazos if rechazos is not None else []
+    inicio = time.perf_counter()
+    entero = mermas_compacta(conn)
+    staging = preparar_staging(df, entero)
+    columnas = {**COLUMNAS_STAGING, 'id_merma': 'BIGINT'} if entero else COLUMNAS_STAGING
+    
+    cursor = conn.cursor()
+    try:
+        # Una tabla de staging por sesión para no interferir con cargas concurrentes
+        cursor.execute("SELECT pg_backend_pid()")
+        tabla = f"staging_mermas_{cursor.fetchone()[0]}"
         
-        print(f"Archivo leído exitosamente: {len(df)} filas, {len(df.columns)} columnas")
+        alinear_claves_guardadas(cursor, staging)
+        definicion = ', '.join(f"{col} {tipo}" for col, tipo in columnas.items())
+        cursor.execute(f"DROP TABLE IF EXISTS {tabla}")
+        cursor.execute(f"CREATE UNLOGGED TABLE {tabla} ({definicion})")
+        copiar_dataframe(cursor, staging, tabla, list(COLUMNAS_STAGING))
+        cursor.execute(f"ANALYZE {tabla}")
         
-        # Conectar a la base de datos
-        print("Conectando a la base de datos...")
-        conn = conectar_db()
-        if not conn:
-            return
+        filas_nuevas = {}
+        for nombre, sql in SQL_STAGING:
+            if nombre == 'mermas':
+                verificar_ids_staging(cursor, tabla)
+            cursor.execute(sql.format(staging=tabla))
+            filas_nuevas[nombre] = cursor.rowcount
+            print(f"{nombre}: {cursor.rowcount} filas nuevas")
         
-        # Crear tablas si no existen
-        crear_tablas(conn)
+        # Filas que no llegaron a Mermas porque una de sus dimensiones no existe (p. ej. sin descripción)
+        cursor.execute(f"""
+        SELECT * FROM (
+            SELECT s.fila,
+                   NOT EXISTS (SELECT 1 FROM ubicacion ub
+                               WHERE ub.nombre_region = s.region AND ub.nombre_comuna = s.comuna
+                                 AND ub.tienda = s.tienda AND ub.zonal = s.zonal) AS sin_ubicacion,
+                   NOT EXISTS (SELECT 1 FROM motivos_detalle md
+                               WHERE md.motivo = s.motivo AND md.ubicacion_motivo = s.ubicacion_motivo) AS sin_motivo,
+                   NOT EXISTS (SELECT 1 FROM producto p WHERE p.codigo_producto = s.codigo_producto) AS sin_producto
+            FROM {tabla} s
+            WHERE s.id_merma IS NOT NULL
+        ) f
+        WHERE sin_ubicacion OR sin_motivo OR sin_producto
+        """)
+        faltantes = np.zeros((len(df), 3), dtype=bool)
+        for fila, *sin_dimension in cursor.fetchall():
+            faltantes[fila] = sin_dimension
+        _, rechazadas = separar_rechazos(df, {
+            codigo: pd.Series(faltantes[:, i], index=df.index)
+            for i, codigo in enumerate(['UBICACION_DESCONOCIDA', 'MOTIVO_DESCONOCIDO', 'PRODUCTO_DESCONOCIDO'])
+        })
+        rechazos.append(rechazadas)
         
-        # Procesar datos de tiempo
-        print("Procesando datos de tiempo...")
+        cursor.execute(f"DROP TABLE {tabla}")
+    finally:
+        cursor.close()
+    
+    duracion = time.perf_counter() - inicio
+    filas_por_segundo = len(staging) / duracion if duracion > 0 else 0
+    print(f"Carga vía staging: {len(staging)} filas en {duracion:.2f}s ({filas_por_segundo:,.0f} filas/s)")
+    
+    return filas_nuevas
+
+# Campos sin los cuales una fila no puede cargarse en Mermas
+COLUMNAS_CRITICAS = ['codigo_producto', 'fecha', 'motivo', 'ubicacion_motivo']
+
+def separar_rechazos(df, motivos):
+    """Separa las filas que cumplen alguna condición de rechazo, anotando los códigos de motivo"""
+    rechazo = pd.Series(False, index=df.index)
+    for mascara in motivos.values():
+        rechazo |= mascara
+    
+    if not rechazo.any():
+        return df, df.iloc[0:0]
+    
+    rechazadas = df[rechazo].copy()
+    codigos = pd.Series('', index=rechazadas.index)
+    for codigo, mascara in motivos.items():
+        codigos = codigos.where(~mascara[rechazo], codigos + '|' + codigo)
+    rechazadas['motivo_rechazo'] = codigos.str.lstrip('|')
+    
+    return df[~rechazo], rechazadas
+
+def validar_dataframe(df):
+    """Valida el DataFrame completo con máscaras vectorizadas; devuelve (filas limpias, filas rechazadas)"""
+    motivos = {}
+    
+    presentes = [col for col in COLUMNAS_CRITICAS if col in df.columns]
+    if presentes:
+        motivos['NULO_CRITICO'] = df[presentes].isna().any(axis=1)
+    
+    if 'fecha' in df.columns:
+        fecha = pd.to_datetime(df['fecha'], errors='coerce')
+        motivos['FECHA_INVALIDA'] = df['fecha'].notna() & fecha.isna()
+    
+    if 'codigo_producto' in df.columns:
+        codigo = pd.to_numeric(df['codigo_producto'], errors='coerce')
+        motivos['CODIGO_NO_NUMERICO'] = df['codigo_producto'].notna() & (codigo.isna() | (codigo % 1 != 0))
+    
+    for col in ['merma_unidad_p', 'merma_monto_p']:
+        if col in df.columns:
+            valor = pd.to_numeric(df[col], errors='coerce')
+            motivos.setdefault('MERMA_NO_NUMERICA', pd.Series(False, index=df.index))
+            motivos['MERMA_NO_NUMERICA'] |= df[col].notna() & valor.isna()
+    
+    return separar_rechazos(df, motivos)
+
+def validar_dimensiones(df, cache):
+    """Rechaza filas cuyos miembros de dimensión no existen (después de cargar las dimensiones)"""
+    motivos = {}
+    
+    if all(col in df.columns for col in DIMENSIONES['ubicacion']['columnas_df']):
+        motivos['UBICACION_DESCONOCIDA'] = cache.resolver('ubicacion', df).isna()
+    
+    if all(col in df.columns for col in DIMENSIONES['motivo']['columnas_df']):
+        motivos['MOTIVO_DESCONOCIDO'] = cache.resolver('motivo', df).isna()
+    
+    if 'codigo_producto' in df.columns:
+        codigos = pd.DataFrame({
+            'codigo_producto': pd.to_numeric(df['codigo_producto'], errors='coerce').astype('Int64')
+        }, index=df.index)
+        motivos['PRODUCTO_DESCONOCIDO'] = cache.resolver('producto', codigos).isna()
+    
+    return separar_rechazos(df, motivos)
+
+def guardar_rechazos(rechazos, archivo, config):
+    """Guarda las filas rechazadas con sus códigos de motivo en CSV o Parquet"""
+    rechazos = [r for r in rechazos if r is not None and len(r)]
+    if not rechazos or not config['dir_rechazos']:
+        return None
+    
+    df = pd.concat(rechazos)
+    df.insert(0, 'fila', df.index)
+    
+    os.makedirs(config['dir_rechazos'], exist_ok=True)
+    nombre = os.path.splitext(os.path.basename(archivo))[0]
+    ruta = os.path.join(config['dir_rechazos'], f"{nombre}_rechazos.{config['formato_rechazos']}")
+    
+    if config['formato_rechazos'] == 'parquet':
+        df.astype({col: str for col in df.columns if df[col].dtype == object}).to_parquet(ruta, index=False)
+    else:
+        df.to_csv(ruta, index=False)
+    
+    print(f"Filas rechazadas: {len(df)} (guardadas en {ruta})")
+    for motivo, cantidad in df['motivo_rechazo'].str.split('|').explode().value_counts().items():
+        print(f"  {motivo}: {cantidad}")
+    return ruta
+
+def reiniciar_memoria_pico():
+    """Reinicia el pico de memoria residente del proceso (solo Linux)"""
+    try:
+        with open('/proc/self/clear_refs', 'w') as archivo:
+            archivo.write('5')
+    except OSError:
+        pass
+
+def memoria_pico():
+    """Memoria residente máxima del proceso en bytes desde el último reinicio"""
+    try:
+        with open('/proc/self/status') as archivo:
+            for linea in archivo:
+                if linea.startswith('VmHWM:'):
+                    return int(linea.split()[1]) * 1024
+    except OSError:
+        pass
+    # Sin /proc: pico de toda la vida del proceso (en KB en Linux, en bytes en macOS)
+    pico = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return pico if sys.platform == 'darwin' else pico * 1024
+
+class MedidorCarga:
+    """Registra tiempo, filas, sentencias SQL y memoria pico de cada etapa de una carga
+    
+    Las etapas pueden anidarse o correr a la vez en varios hilos (dimensiones concurrentes,
+    pipeline). El pico de memoria es del proceso: en una etapa que se solapó con otra
+    incluye la memoria de las demás, y queda marcada con memoria_compartida.
+    """
+    
+    def __init__(self, archivo=None):
+        self.archivo = archivo
+        self.inicio = datetime.now()
+        self.etapas = {}
+        self.intervalos = []
+        self._activas = 0
+        self._iniciadas = 0
+        self._lock = threading.Lock()
+    
+    @contextmanager
+    def etapa(self, nombre, conn=None, filas_entrada=None):
+        """Mide una etapa; el bloque puede fijar registro['filas_salida']
+        
+        Si la etapa se repite (carga por bloques) los valores se acumulan.
+        """
+        registro = {'filas_salida': None}
+        sentencias_antes = getattr(conn, 'sentencias', 0)
+        with self._lock:
+            # Reiniciar el pico con otra etapa en curso le borraría el suyo
+            solapada = self._activas > 0
+            if not solapada:
+                reiniciar_memoria_pico()
+            self._activas += 1
+            self._iniciadas += 1
+            iniciadas_antes = self._iniciadas
+        inicio = time.perf_counter()
+        try:
+            yield registro
+        finally:
+            fin = time.perf_counter()
+            with self._lock:
+                self._activas -= 1
+                solapada = solapada or self._iniciadas > iniciadas_antes
+                self.intervalos.append((inicio, fin))
+                etapa = self.etapas.setdefault(nombre, {
+                    'segundos': 0.0, 'filas_entrada': 0, 'filas_salida': 0, 'sentencias_sql': 0,
+                    'filas_por_segundo': None, 'memoria_pico_bytes': 0, 'memoria_compartida': False
+                })
+                etapa['segundos'] += fin - inicio
+                etapa['filas_entrada'] += filas_entrada or 0
+                etapa['filas_salida'] += registro['filas_salida'] or 0
+                etapa['sentencias_sql'] += getattr(conn, 'sentencias', 0) - sentencias_antes
+                etapa['memoria_pico_bytes'] = max(etapa['memoria_pico_bytes'], memoria_pico())
+                etapa['memoria_compartida'] = etapa['memoria_compartida'] or solapada
+                if etapa['segundos'] > 0:
+                    filas = etapa['filas_entrada'] or etapa['filas_salida']
+                    etapa['filas_por_segundo'] = round(filas / etapa['segundos'], 1)
+    
+    def segundos_total(self):
+        """Tiempo de reloj cubierto por las etapas: lo anidado o solapado se cuenta una sola vez"""
+        total = 0.0
+        hasta = None
+        for inicio, fin in sorted(self.intervalos):
+            if hasta is None or inicio > hasta:
+                total += fin - inicio
+                hasta = fin
+            elif fin > hasta:
+                total += fin - hasta
+                hasta = fin
+        return total
+    
+    def reporte(self):
+        """Devuelve el reporte estructurado de la carga"""
+        return {
+            'archivo': self.archivo,
+            'inicio': self.inicio.isoformat(timespec='seconds'),
+            'segundos_total': round(self.segundos_total(), 4),
+            'sentencias_sql_total': sum(etapa['sentencias_sql'] for etapa in self.etapas.values()),
+            'etapas': {nombre: {**etapa, 'segundos': round(etapa['segundos'], 4)}
+                       for nombre, etapa in self.etapas.items()}
+        }
+    
+    def imprimir(self):
+        """Muestra una tabla resumen de las etapas"""
+        print("=== ETAPAS DE LA CARGA ===")
+        for nombre, etapa in self.etapas.items():
+            print(f"{nombre:<14} {etapa['segundos']:8.2f}s {etapa['filas_entrada']:>10} -> {etapa['filas_salida']:<10} "
+                  f"{etapa['sentencias_sql']:>7} SQL {(etapa['filas_por_segundo'] or 0):>12,.0f} filas/s "
+                  f"{etapa['memoria_pico_bytes'] / 1024 / 1024:>8.1f} MB{'*' if etapa['memoria_compartida'] else ''}")
+        print(f"Total: {self.segundos_total():.2f}s")
+        if any(etapa['memoria_compartida'] for etapa in self.etapas.values()):
+            print("* memoria pico del proceso completo: la etapa corrió junto con otras")
+    
+    def guardar_json(self, ruta):
+        """Guarda el reporte en formato JSON"""
+        escribir_atomico(ruta, json.dumps(self.reporte(), indent=2, ensure_ascii=False, default=str))
+    
+    def guardar_prometheus(self, ruta):
+        """Guarda las métricas en formato textfile de Prometheus (node_exporter)"""
+        metricas = [
+            ('segundos', 'Duración de la etapa en segundos'),
+            ('filas_entrada', 'Filas recibidas por la etapa'),
+            ('filas_salida', 'Filas escritas por la etapa'),
+            ('sentencias_sql', 'Sentencias SQL ejecutadas en la etapa'),
+            ('filas_por_segundo', 'Filas procesadas por segundo'),
+            ('memoria_pico_bytes', 'Memoria residente máxima durante la etapa'),
+            ('memoria_compartida', '1 si la memoria pico es del proceso completo (la etapa se solapó con otras)')
+        ]
+        archivo = os.path.basename(self.archivo or '')
+        lineas = []
+        for metrica, descripcion in metricas:
+            lineas.append(f"# HELP mermas_etapa_{metrica} {descripcion}")
+            lineas.append(f"# TYPE mermas_etapa_{metrica} gauge")
+            for nombre, etapa in self.etapas.items():
+                valor = int(etapa[metrica]) if isinstance(etapa[metrica], bool) else etapa[metrica] or 0
+                lineas.append(f'mermas_etapa_{metrica}{{archivo="{archivo}",etapa="{nombre}"}} {valor}')
+        escribir_atomico(ruta, '\n'.join(lineas) + '\n')
+    
+    def guardar(self, config):
+        """Guarda los reportes configurados ('{archivo}' en la ruta se reemplaza por el nombre del archivo)"""
+        nombre = os.path.splitext(os.path.basename(self.archivo or 'carga'))[0]
+        if config.get('reporte_json'):
+            self.guardar_json(config['reporte_json'].format(archivo=nombre))
+        if config.get('reporte_prometheus'):
+            self.guardar_prometheus(config['reporte_prometheus'].format(archivo=nombre))
+
+def escribir_atomico(ruta, contenido):
+    """Escribe un archivo de texto reemplazándolo de forma atómica"""
+    directorio = os.path.dirname(ruta)
+    if directorio:
+        os.makedirs(directorio, exist_ok=True)
+    ruta_temporal = f"{ruta}.{os.getpid()}.tmp"
+    with open(ruta_temporal, 'w', encoding='utf-8') as archivo:
+        archivo.write(contenido)
+    os.replace(ruta_temporal, ruta)
+
+def archivo_en_manifiesto(conn, hash_contenido):
+    """Indica si un archivo con exactamente el mismo contenido ya fue cargado"""
+    cursor = conn.cursor()
+    try:
+        cursor.execute("SELECT archivo, cargado_en FROM carga_manifiesto WHERE hash_archivo = %s", (hash_contenido,))
+        return cursor.fetchone()
+    finally:
+        cursor.close()
+
+def digest_por_fecha(df):
+    """Calcula un digest del contenido de las filas de cada fecha (independiente del orden de las filas)"""
+    fechas = pd.to_datetime(df['fecha'], errors='coerce').dt.date
+    hashes_filas = pd.util.hash_pandas_object(df.astype(str), index=False).to_numpy()
+    
+    digests = {}
+    for fecha, posiciones in pd.Series(range(len(df))).groupby(fechas.to_numpy()).groups.items():
+        suma = int(np.sum(hashes_filas[list(posiciones)], dtype=np.uint64))
+        digests[fecha] = f"{suma:016x}"
+    return digests
+
+def filtrar_incremental(conn, df):
+    """Deja solo las filas de fechas nuevas (sobre la marca de agua) o cuyo contenido cambió
+    
+    Los digests se guardan por fecha y no por archivo, así una exportación diaria con la
+    fecha en el nombre se compara contra lo que ya cargaron las anteriores.
+    """
+    digests = digest_por_fecha(df)
+    
+    cursor = conn.cursor()
+    try:
+        cursor.execute("SELECT MAX(fecha) FROM carga_fechas")
+        marca_agua = cursor.fetchone()[0]
+        
+        # Las fechas sobre la marca de agua son nuevas: solo se comparan las anteriores
+        anteriores = {}
+        if marca_agua is not None and digests:
+            cursor.execute("SELECT fecha, hash_contenido FROM carga_fechas WHERE fecha BETWEEN %s AND %s",
+                           (min(digests), marca_agua))
+            anteriores = dict(cursor.fetchall())
+    finally:
+        cursor.close()
+    
+    nuevas = [fecha for fecha in digests if marca_agua is None or fecha > marca_agua]
+    modificadas = [fecha for fecha, digest in digests.items()
+                   if marca_agua is not None and fecha <= marca_agua and anteriores.get(fecha) != digest]
+    
+    fechas = pd.to_datetime(df['fecha'], errors='coerce').dt.date
+    df_filtrado = df[fechas.isin(nuevas + modificadas).to_numpy()]
+    
+    print(f"Carga incremental: marca de agua {marca_agua}, {len(nuevas)} fechas nuevas, "
+          f"{len(modificadas)} fechas modificadas, {len(df_filtrado)} de {len(df)} filas a cargar")
+    
+    return df_filtrado, digests
+
+def marcar_meses_cargados(cursor, fecha_min, fecha_max):
+    """Sube la versión de los meses del rango en carga_versiones
+    
+    Las cachés de consultas de cualquier proceso comparan estas versiones antes de
+    devolver un resultado guardado. Los meses se toman en orden, así cargas
+    simultáneas bloquean las filas en el mismo orden.
+    """
+    if fecha_min is None or fecha_max is None:
+        return
+    cursor.execute("""
+    INSERT INTO carga_versiones (mes, version, actualizado_en)
+    SELECT mes::date, 1, now()
+    FROM generate_series(date_trunc('month', %s::date), %s::date, interval '1 month') AS mes
+    ORDER BY mes
+    ON CONFLICT (mes) DO UPDATE SET version = carga_versiones.version + 1, actualizado_en = now()
+    """, (fecha_min, fecha_max))
+
+def version_meses(cursor, desde=None, hasta=None):
+    """Suma de las versiones de los meses del rango (sin rango, de todos): sube con cada carga que los toca"""
+    cursor.execute("""
+    SELECT COALESCE(SUM(version), 0) FROM carga_versiones
+    WHERE mes >= COALESCE(date_trunc('month', %s::date), '-infinity') AND mes <= COALESCE(%s::date, 'infinity')
+    """, (desde, hasta))
+    return cursor.fetchone()[0]
+
+def registrar_carga(conn, archivo, hash_contenido, filas, fecha_min, fecha_max, digests=None):
+    """Registra el archivo cargado en el manifiesto (en la misma transacción que los datos)"""
+    nombre = os.path.basename(archivo)
+    cursor = conn.cursor()
+    try:
+        cursor.execute("""
+        INSERT INTO carga_manifiesto (hash_archivo, archivo, filas, fecha_min, fecha_max, cargado_en)
+        VALUES (%s, %s, %s, %s, %s, now())
+        ON CONFLICT (hash_archivo) DO UPDATE SET cargado_en = EXCLUDED.cargado_en
+        """, (hash_contenido, nombre, filas, fecha_min, fecha_max))
+        marcar_meses_cargados(cursor, fecha_min, fecha_max)
+        
+        if digests:
+            # En orden de fecha, para que cargas simultáneas tomen los bloqueos en el mismo orden
+            psycopg2.extras.execute_values(cursor, """
+            INSERT INTO carga_fechas (fecha, hash_contenido, archivo)
+            VALUES %s
+            ON CONFLICT (fecha) DO UPDATE SET hash_contenido = EXCLUDED.hash_contenido, archivo = EXCLUDED.archivo
+            """, [(fecha, digest, nombre) for fecha, digest in sorted(digests.items())])
+    finally:
+        cursor.close()
+
+def leer_checkpoint(conn, hash_contenido):
+    """Devuelve el progreso confirmado de una carga reanudable de este contenido, o None"""
+    cursor = conn.cursor()
+    try:
+        cursor.execute("""
+        SELECT bloques_confirmados, filas_confirmadas, fecha_min, fecha_max, meses_vaciados, actualizado_en,
+               filas_por_bloque
+        FROM carga_checkpoint WHERE hash_archivo = %s
+        """, (hash_contenido,))
+        fila = cursor.fetchone()
+        if fila is None:
+            return None
+        return {'bloques': fila[0], 'filas': fila[1], 'fecha_min': fila[2], 'fecha_max': fila[3],
+                'meses_vaciados': {datetime.strptime(mes, '%Y-%m-%d').date() for mes in json.loads(fila[4] or '[]')},
+                'actualizado_en': fila[5], 'filas_por_bloque': fila[6]}
+    finally:
+        cursor.close()
+
+def guardar_checkpoint(conn, archivo, hash_contenido, bloques, filas, filas_por_bloque, fecha_min, fecha_max, meses_vaciados):
+    """Registra el progreso de una carga reanudable (en la misma transacción que el bloque)"""
+    cursor = conn.cursor()
+    try:
+        cursor.execute("""
+        INSERT INTO carga_checkpoint (hash_archivo, archivo, bloques_confirmados, filas_confirmadas, filas_por_bloque,
+                                      fecha_min, fecha_max, meses_vaciados, actualizado_en)
+        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, now())
+        ON CONFLICT (hash_archivo) DO UPDATE SET
+            bloques_confirmados = EXCLUDED.bloques_confirmados,
+            filas_confirmadas = EXCLUDED.filas_confirmadas,
+            filas_por_bloque = EXCLUDED.filas_por_bloque,
+            fecha_min = EXCLUDED.fecha_min,
+            fecha_max = EXCLUDED.fecha_max,
+            meses_vaciados = EXCLUDED.meses_vaciados,
+            actualizado_en = EXCLUDED.actualizado_en
+        """, (hash_contenido, os.path.basename(archivo), bloques, filas, filas_por_bloque, fecha_min, fecha_max,
+              json.dumps(sorted(mes.isoformat() for mes in meses_vaciados))))
+        # El bloque ya es visible al confirmarse: las consultas cacheadas de esos meses caducan
+        marcar_meses_cargados(cursor, fecha_min, fecha_max)
+    finally:
+        cursor.close()
+
+def borrar_checkpoint(conn, hash_contenido):
+    """Elimina el checkpoint de una carga ya terminada"""
+    cursor = conn.cursor()
+    try:
+        cursor.execute("DELETE FROM carga_checkpoint WHERE hash_archivo = %s", (hash_contenido,))
+    finally:
+        cursor.close()
+
+def leer_rechazos(archivo, config):
+    """Lee las filas rechazadas ya guardadas de un archivo (para continuar una carga reanudada)"""
+    if not config['dir_rechazos']:
+        return None
+    nombre = os.path.splitext(os.path.basename(archivo))[0]
+    ruta = os.path.join(config['dir_rechazos'], f"{nombre}_rechazos.{config['formato_rechazos']}")
+    if not os.path.exists(ruta):
+        return None
+    
+    df = pd.read_parquet(ruta) if config['formato_rechazos'] == 'parquet' else pd.read_csv(ruta)
+    return df.set_index('fila')
+
+def cargar_dimensiones_concurrentes(pool, df, cache, config, medidor):
+    """Carga las dimensiones en paralelo, cada etapa en su propia conexión del pool y confirmada al terminar
+    
+    Solo Producto depende de otra dimensión (Categoría), así que se encadena detrás de ella;
+    el resto corre a la vez. Vuelve cuando todas las dimensiones están confirmadas.
+    """
+    filas = len(df)
+    
+    def etapa(nombre, funcion, *args):
+        conn = pool.getconn()
+        try:
+            with medidor.etapa(nombre, conn, filas) as registro:
+                registro['filas_salida'] = funcion(conn, df, *args)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            pool.putconn(conn)
+    
+    def categoria_y_producto():
+        etapa('categoria', insertar_categoria, cache)
+        etapa('producto', insertar_producto, cache)
+    
+    print("Insertando dimensiones en paralelo...")
+    with ThreadPoolExecutor(4) as ejecutor:
+        futuros = [ejecutor.submit(etapa, 'ubicacion', insertar_ubicacion, cache),
+                   ejecutor.submit(etapa, 'motivos', insertar_motivo_detalle, cache),
+                   ejecutor.submit(categoria_y_producto)]
         if 'fecha' in df.columns:
-            fechas_unicas = df['fecha'].dropna().unique()
-            for fecha in fechas_unicas:
-                fecha_data = calcular_datos_tiempo(fecha)
-                insertar_tiempo(conn, fecha_data)
+            futuros.append(ejecutor.submit(etapa, 'tiempo', cargar_tiempo, config['años_calendario']))
         else:
             print("Advertencia: Columna 'fecha' no encontrada")
         
+        # Propagar el primer error recién cuando todas las etapas terminaron
+        wait(futuros)
+        for futuro in futuros:
+            futuro.result()
+
+def cargar_dataframe(conn, df, cache, config, medidor=None, rechazos=None, pool=None):
+    """Carga un DataFrame normalizado y validado en las dimensiones y la tabla de hechos
+    
+    Con pool, las dimensiones se cargan en paralelo en conexiones propias y se confirman
+    antes de cargar los hechos. Las filas con miembros de dimensión desconocidos se
+    agregan a rechazos.
+    """
+    medidor = medidor or MedidorCarga()
+    rechazos = rechazos if rechazos is not None else []
+    filas = len(df)
+    
+    if pool is not None:
+        with medidor.etapa('dimensiones', filas_entrada=filas):
+            cargar_dimensiones_concurrentes(pool, df, cache, config, medidor)
+    else:
+        # Procesar datos de tiempo
+        print("Procesando datos de tiempo...")
+        with medidor.etapa('tiempo', conn, filas) as etapa:
+            if 'fecha' in df.columns:
+                etapa['filas_salida'] = cargar_tiempo(conn, df, config['años_calendario'])
+            else:
+                print("Advertencia: Columna 'fecha' no encontrada")
+        
         # Insertar ubicaciones
         print("Insertando ubicaciones...")
-        insertar_ubicacion(conn, df)
+        with medidor.etapa('ubicacion', conn, filas) as etapa:
+            etapa['filas_salida'] = insertar_ubicacion(conn, df, cache)
         
         # Insertar categorías
         print("Insertando categorías...")
-        insertar_categoria(conn, df)
+        with medidor.etapa('categoria', conn, filas) as etapa:
+            etapa['filas_salida'] = insertar_categoria(conn, df, cache)
         
         # Insertar productos
         print("Insertando productos...")
-        insertar_producto(conn, df)
+        with medidor.etapa('producto', conn, filas) as etapa:
+            etapa['filas_salida'] = insertar_producto(conn, df, cache)
         
         # Insertar motivos
         print("Insertando motivos...")
-        insertar_motivo_detalle(conn, df)
+        with medidor.etapa('motivos', conn, filas) as etapa:
+            etapa['filas_salida'] = insertar_motivo_detalle(conn, df, cache)
+    
+    # Solo llegan a la tabla de hechos filas con todas sus dimensiones resueltas
+    with medidor.etapa('validacion_dimensiones', filas_entrada=filas) as etapa:
+        df, rechazadas = validar_dimensiones(df, cache)
+        rechazos.append(rechazadas)
+        etapa['filas_salida'] = len(df)
+    filas = len(df)
+    
+    # Insertar mermas
+    print("Insertando mermas...")
+    with medidor.etapa('mermas', conn, filas) as etapa:
+        if config['modo_mermas'] == 'copy':
+            etapa['filas_salida'] = insertar_mermas_copy(conn, df, config['tamano_lote'], cache)
+        else:
+            etapa['filas_salida'] = insertar_mermas(conn, df, cache)
+
+async def ejecutar_pipeline(bloques, transformar, escribir, medidor, profundidad=2, saltar=0):
+    """Procesa los bloques en tres etapas asyncio unidas por colas acotadas: lectura, transformación y escritura
+    
+    El trabajo bloqueante de cada etapa corre en un hilo (asyncio.to_thread), así que mientras se
+    escribe el bloque N ya se leen y transforman los siguientes; una cola llena frena a la etapa
+    anterior. Si una etapa falla se cancelan las demás y se propaga el error.
+    """
+    bloques = iter(bloques)
+    leidos = asyncio.Queue(profundidad)
+    transformados = asyncio.Queue(profundidad)
+    
+    def leer_siguiente():
+        with medidor.etapa('lectura') as etapa:
+            df = next(bloques, None)
+            etapa['filas_salida'] = len(df) if df is not None else 0
+        return df
+    
+    async def lector():
+        numero = 0
+        while (df := await asyncio.to_thread(leer_siguiente)) is not None:
+            numero += 1
+            if numero > saltar:
+                await leidos.put((numero, df))
+        await leidos.put(None)
+    
+    async def transformador():
+        while (bloque := await leidos.get()) is not None:
+            numero, df = bloque
+            await transformados.put((numero, *await asyncio.to_thread(transformar, df)))
+        await transformados.put(None)
+    
+    async def escritor():
+        while (bloque := await transformados.get()) is not None:
+            await asyncio.to_thread(escribir, *bloque)
+    
+    tareas = [asyncio.create_task(etapa()) for etapa in (lector, transformador, escritor)]
+    try:
+        await asyncio.gather(*tareas)
+    except BaseException:
+        for tarea in tareas:
+            tarea.cancel()
+        await asyncio.gather(*tareas, return_exceptions=True)
+        raise
+
+def cargar_archivo(conn, archivo_excel, config, df=None, medidor=None, pool=None, iniciar_escritura=None):
+    """Carga un archivo usando la conexión recibida, sin confirmar la transacción
+    
+    Si se entrega df (ya leído y normalizado) no se vuelve a leer el archivo.
+    En modo reanudable, en cambio, se confirma cada bloque de filas_por_commit filas
+    junto con su checkpoint, y una carga interrumpida continúa desde el último bloque
+    confirmado, con el tamaño de bloque guardado en el checkpoint; solo el cierre
+    (resúmenes y manifiesto) queda para el llamador.
+    Con pool, las dimensiones se cargan en paralelo en conexiones de ese pool.
+    Si se entrega iniciar_escritura, se llama con las filas que de verdad se van a
+    cargar (tras el manifiesto, el filtro incremental y el checkpoint) justo antes de
+    escribir; procesar_excel decide ahí la carga masiva.
+    Devuelve un resumen de la carga, o None si el archivo se saltó.
+    """
+    medidor = medidor or MedidorCarga(archivo_excel)
+    
+    # Vaciar meses completos y cargar solo las fechas cambiadas borraría los días sin cambios
+    if config['reemplazar_meses'] and config['incremental']:
+        raise ValueError("reemplazar_meses no puede combinarse con la carga incremental")
+    
+    reanudable = config['reanudable']
+    por_bloques = df is None and (config['tamano_bloque'] or reanudable or config['pipeline'])
+    # El filtro por fechas necesita el archivo completo: leído por bloques no se aplicaría
+    if config['incremental'] and por_bloques:
+        raise ValueError("la carga incremental no puede combinarse con tamano_bloque, reanudable ni pipeline")
+    
+    # En modo incremental un archivo idéntico a uno ya cargado se salta por completo
+    hash_contenido = hash_archivo(archivo_excel)
+    if config['incremental']:
+        cargado = archivo_en_manifiesto(conn, hash_contenido)
+        if cargado:
+            print(f"Archivo sin cambios (ya cargado como '{cargado[0]}' el {cargado[1]}), no se procesa")
+            return None
+    
+    checkpoint = leer_checkpoint(conn, hash_contenido) if reanudable else None
+    # Se reanuda contando bloques: deben tener el mismo tamaño que en la carga interrumpida
+    filas_por_commit = config['filas_por_commit']
+    if checkpoint and checkpoint['filas_por_bloque'] and checkpoint['filas_por_bloque'] != filas_por_commit:
+        print(f"Advertencia: la carga interrumpida usaba filas_por_commit={checkpoint['filas_por_bloque']}; "
+              f"se reanuda con ese valor en lugar de {filas_por_commit}")
+        filas_por_commit = checkpoint['filas_por_bloque']
+    
+    digests = None
+    if por_bloques:
+        # Lectura por streaming: el archivo se procesa bloque a bloque (en modo reanudable, un bloque por commit)
+        tamano_bloque = filas_por_commit if reanudable else config['tamano_bloque'] or config['tamano_lote']
+        print(f"Leyendo archivo en bloques de {tamano_bloque} filas...")
+        bloques = leer_por_bloques(archivo_excel, {**config, 'tamano_bloque': tamano_bloque})
+    else:
+        if df is None:
+            # Leer el archivo y normalizar nombres de columnas (quitar tildes), o reutilizar la caché
+            print(f"Leyendo archivo ({formato_de(archivo_excel, config)})...")
+            with medidor.etapa('lectura') as etapa:
+                df = leer_archivo_cacheado(archivo_excel, config)
+                etapa['filas_salida'] = len(df)
         
-        # Insertar mermas
-        print("Insertando mermas...")
-        insertar_mermas(conn, df)
+        print(f"Archivo leído exitosamente: {len(df)} filas, {len(df.columns)} columnas")
         
-        # Confirmar cambios
-        conn.commit()
-        print("¡Datos insertados exitosamente!")
+        # Solo las fechas nuevas o modificadas desde la última carga de este archivo
+        if config['incremental'] and 'fecha' in df.columns:
+            df, digests = filtrar_incremental(conn, df)
+        bloques = [df]
+        if reanudable and len(df):
+            tamano = filas_por_commit
+            bloques = [df.iloc[desde:desde + tamano] for desde in range(0, len(df), tamano)]
+    
+    # Cargar una sola vez los mapas de claves de las dimensiones
+    cache = CacheDimensiones()
+    cache.cargar(conn)
+    
+    particionada = mermas_particionada(conn)
+    if config['reemplazar_meses'] and not particionada:
+        print("Advertencia: reemplazar_meses requiere la tabla 'mermas' particionada, se ignora")
+    meses_vaciados = set()
+    
+    total_filas = 0
+    fecha_min = fecha_max = None
+    rechazos = []
+    confirmados = 0
+    if checkpoint:
+        # Continuar la carga interrumpida: lo confirmado no se vuelve a cargar
+        print(f"Reanudando carga desde el bloque {checkpoint['bloques'] + 1} "
+              f"({checkpoint['filas']} filas confirmadas el {checkpoint['actualizado_en']})")
+        confirmados = checkpoint['bloques']
+        total_filas = checkpoint['filas']
+        fecha_min, fecha_max = checkpoint['fecha_min'], checkpoint['fecha_max']
+        meses_vaciados = checkpoint['meses_vaciados']
+        rechazos.append(leer_rechazos(archivo_excel, config))
+    
+    def transformar(df):
+        """Normaliza y valida un bloque; devuelve (filas limpias, filas leídas, rechazos del bloque)"""
+        with medidor.etapa('normalizacion', filas_entrada=len(df)) as etapa:
+            df = normalizar_dataframe(df)
+            etapa['filas_salida'] = len(df)
+        
+        # Las filas inválidas se separan antes de tocar la base de datos
+        with medidor.etapa('validacion', filas_entrada=len(df)) as etapa:
+            filas_leidas = len(df)
+            df, rechazadas = validar_dataframe(df)
+            etapa['filas_salida'] = len(df)
+        return df, filas_leidas, [rechazadas]
+    
+    def escribir(numero, df, filas_leidas, rechazos_bloque):
+        """Carga un bloque ya transformado en la base de datos
+        
+        Los rechazos del bloque pasan a rechazos solo si el bloque se escribe: en el
+        pipeline el bloque siguiente ya puede estar transformado cuando este falla.
+        """
+        nonlocal total_filas, fecha_min, fecha_max
+        if por_bloques:
+            print(f"--- Bloque {numero}: {len(df)} filas ---")
+        if particionada and 'fecha' in df.columns:
+            with medidor.etapa('particiones', conn, len(df)):
+                if pool is not None:
+                    # Crear una partición bloquea las tablas referenciadas por sus FKs hasta el commit:
+                    # se crean y confirman aparte para no frenar a las dimensiones concurrentes
+                    conn_particiones = pool.getconn()
+                    try:
+                        preparar_particiones(conn_particiones, df, set(), False)
+                        conn_particiones.commit()
+                    finally:
+                        pool.putconn(conn_particiones)
+                preparar_particiones(conn, df, meses_vaciados, config['reemplazar_meses'])
+        if config['motor'] == 'staging':
+            with medidor.etapa('staging', conn, len(df)) as etapa:
+                etapa['filas_salida'] = sum(cargar_via_staging(conn, df, rechazos_bloque).values())
+        else:
+            cargar_dataframe(conn, df, cache, config, medidor, rechazos_bloque, pool)
+        rechazos.extend(rechazos_bloque)
+        total_filas += filas_leidas
+        
+        if 'fecha' in df.columns:
+            fechas = pd.to_datetime(df['fecha'], errors='coerce').dropna()
+            if not fechas.empty:
+                fecha_min = min(filter(None, [fecha_min, fechas.min().date()]))
+                fecha_max = max(filter(None, [fecha_max, fechas.max().date()]))
+        
+        if reanudable:
+            # El bloque y su checkpoint se confirman juntos
+            guardar_checkpoint(conn, archivo_excel, hash_contenido, numero, total_filas, filas_por_commit,
+                               fecha_min, fecha_max, meses_vaciados)
+            guardar_rechazos(rechazos, archivo_excel, config)
+            conn.commit()
+            print(f"Checkpoint: bloque {numero} confirmado ({total_filas} filas)")
+    
+    if iniciar_escritura is not None:
+        if por_bloques:
+            iniciar_escritura(max(contar_filas(archivo_excel, config) - total_filas, 0))
+        else:
+            iniciar_escritura(sum(len(bloque) for bloque in bloques[confirmados:]))
+    
+    if config['pipeline'] and por_bloques:
+        asyncio.run(ejecutar_pipeline(bloques, transformar, escribir, medidor, config['profundidad_cola'], confirmados))
+    else:
+        bloques = iter(bloques)
+        numero = 0
+        while True:
+            # Al leer por streaming la lectura ocurre al pedir cada bloque
+            with medidor.etapa('lectura') if por_bloques else nullcontext({}) as etapa:
+                df = next(bloques, None)
+                etapa['filas_salida'] = len(df) if df is not None else 0
+            if df is None:
+                break
+            numero += 1
+            if numero <= confirmados:
+                continue
+            escribir(numero, *transformar(df))
+    cache.reportar()
+    guardar_rechazos(rechazos, archivo_excel, config)
+    
+    # Los dashboards leen las tablas resumen: se rehacen solo los meses tocados
+    if config['resumenes'] and fecha_min is not None:
+        with medidor.etapa('resumenes', conn) as etapa:
+            etapa['filas_salida'] = refrescar_resumenes(conn, fecha_min, fecha_max)
+    
+    # Registrar el archivo en el manifiesto junto con los datos
+    registrar_carga(conn, archivo_excel, hash_contenido, total_filas, fecha_min, fecha_max, digests)
+    if reanudable:
+        borrar_checkpoint(conn, hash_contenido)
+    
+    medidor.imprimir()
+    medidor.guardar(config)
+    
+    return {'archivo': archivo_excel, 'filas': total_filas, 'fecha_min': fecha_min, 'fecha_max': fecha_max}
+
+# Hechos de Mermas con los atributos de todas sus dimensiones, para el espejo analítico
+SQL_ESPEJO = """
+SELECT m.id_merma::text AS id_merma, m.fecha, m.merma_unidad, m.merma_monto::float8 AS merma_monto,
+       t.año::smallint AS año, t.añotrimestre, t.mes, t.mesnum::smallint AS mesnum, t.semana::smallint AS semana,
+       t.dia, t.diasemananum::smallint AS diasemananum, t.trimestre, t.semestre,
+       u.nombre_region, u.codigo_region, u.nombre_comuna, u.tienda, u.zonal,
+       m.codigo_producto, p.nombre_producto, p.linea, p.seccion, p.negocio, p.abastecimiento,
+       c.nombre_categoria, md.motivo, md.ubicacion_motivo
+FROM mermas m
+JOIN tiempo t ON t.fecha = m.fecha
+LEFT JOIN ubicacion u ON u.id_ubicacion = m.id_comuna
+LEFT JOIN producto p ON p.codigo_producto = m.codigo_producto
+LEFT JOIN categoria c ON c.id_categoria = p.id_categoria
+LEFT JOIN motivos_detalle md ON md.id_motivo = m.id_motivo::int
+WHERE m.fecha >= %s AND m.fecha < %s
+ORDER BY m.fecha
+"""
+
+# Tipos Arrow de las columnas del espejo, en el orden de SQL_ESPEJO. Fijos para que todos los
+# meses tengan el mismo esquema sin importar el esquema de la base (compacto o no) ni los nulos
+ESQUEMA_ESPEJO = {
+    'id_merma': 'string', 'fecha': 'date32', 'merma_unidad': 'int32', 'merma_monto': 'float64',
+    'año': 'int16', 'añotrimestre': 'string', 'mes': 'string', 'mesnum': 'int16', 'semana': 'int16',
+    'dia': 'string', 'diasemananum': 'int16', 'trimestre': 'string', 'semestre': 'string',
+    'nombre_region': 'string', 'codigo_region': 'string', 'nombre_comuna': 'string', 'tienda': 'string', 'zonal': 'string',
+    'codigo_producto': 'int32', 'nombre_producto': 'string', 'linea': 'string', 'seccion': 'string',
+    'negocio': 'string', 'abastecimiento': 'string',
+    'nombre_categoria': 'string', 'motivo': 'string', 'ubicacion_motivo': 'string',
+}
+
+def exportar_espejo(conn, meses, directorio, filas_por_grupo=100000):
+    """Reescribe en el espejo Parquet (un directorio añomes=AAAA-MM por mes) solo los meses indicados
+    
+    Cada mes se lee con un cursor del lado del servidor y se escribe por grupos de filas,
+    así la memoria no depende del tamaño del mes. El archivo se reemplaza de forma atómica.
+    Devuelve las filas exportadas.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    
+    esquema = pa.schema([(columna, getattr(pa, tipo)()) for columna, tipo in ESQUEMA_ESPEJO.items()])
+    total = 0
+    inicio = time.perf_counter()
+    ruta_temporal = None
+    try:
+        for mes in sorted(set(meses)):
+            particion = os.path.join(directorio, f"añomes={mes:%Y-%m}")
+            ruta = os.path.join(particion, 'mermas.parquet')
+            ruta_temporal = f"{ruta}.{os.getpid()}.tmp"
+            os.makedirs(particion, exist_ok=True)
+            
+            cursor = conn.cursor(name='espejo_mermas')
+            cursor.itersize = filas_por_grupo
+            filas = 0
+            try:
+                cursor.execute(SQL_ESPEJO, (mes, (pd.Timestamp(mes) + pd.offsets.MonthBegin(1)).date()))
+                with pq.ParquetWriter(ruta_temporal, esquema, compression='zstd') as escritor:
+                    while lote := cursor.fetchmany(filas_por_grupo):
+                        columnas = zip(*lote)
+                        escritor.write_table(pa.Table.from_arrays(
+                            [pa.array(valores, type=campo.type) for campo, valores in zip(esquema, columnas)],
+                            schema=esquema))
+                        filas += len(lote)
+            finally:
+                cursor.close()
+            
+            if filas:
+                os.replace(ruta_temporal, ruta)
+            else:
+                # El mes quedó sin hechos: se quita su partición
+                os.remove(ruta_temporal)
+                if os.path.exists(ruta):
+                    os.remove(ruta)
+                os.rmdir(particion)
+            total += filas
+    finally:
+        conn.rollback()
+        # Un error a mitad de un mes deja su archivo temporal
+        if ruta_temporal and os.path.exists(ruta_temporal):
+            os.remove(ruta_temporal)
+    
+    print(f"Espejo Parquet: {len(set(meses))} meses reescritos en {directorio} "
+          f"({total} filas, {time.perf_counter() - inicio:.1f}s)")
+    return total
+
+def actualizar_espejo(conn, config, fecha_min, fecha_max):
+    """Reescribe los meses del espejo tocados por una carga ya confirmada (un error no deshace la carga)"""
+    if not config['dir_espejo'] or fecha_min is None:
+        return
+    try:
+        exportar_espejo(conn, meses_en_rango(fecha_min, fecha_max), config['dir_espejo'])
+    except Exception as e:
+        print(f"Advertencia: No se pudo actualizar el espejo Parquet: {e}")
+
+def procesar_excel(archivo_excel, **opciones):
+    """Función principal para procesar el archivo Excel"""
+    config = {**CARGA_CONFIG, **opciones}
+    conn = None
+    pool = None
+    
+    try:
+        # Conectar a la base de datos
+        print("Conectando a la base de datos...")
+        conn = conectar_db()
+        if not conn:
+            return
+        
+        # Una conexión por cada etapa de dimensión que puede correr a la vez
+        if config['dimensiones_concurrentes'] and config['motor'] == 'python':
+            pool = psycopg2.pool.ThreadedConnectionPool(1, 4, connection_factory=ConexionInstrumentada, **DB_CONFIG)
+        
+        # Crear tablas si no existen
+        crear_tablas(conn, config['particionado'], config['indice_fecha'], config['tipos_compactos'])
+        
+        # La carga masiva se decide dentro de cargar_archivo, con las filas que de verdad se
+        # cargan (un archivo sin cambios no quita nada); se reconstruye al salir, tras el commit
+        with ExitStack() as masiva:
+            def iniciar_escritura(filas):
+                masiva.enter_context(carga_masiva(conn, usar_carga_masiva(config, filas)))
+            
+            resumen = cargar_archivo(conn, archivo_excel, config, pool=pool, iniciar_escritura=iniciar_escritura)
+            if resumen is None:
+                return
+            
+            # Confirmar cambios
+            conn.commit()
+            CACHE_CONSULTAS.invalidar(resumen['fecha_min'], resumen['fecha_max'])
+        print(f"¡Datos insertados exitosamente! ({resumen['filas']} filas leídas)")
+        
+        actualizar_espejo(conn, config, resumen['fecha_min'], resumen['fecha_max'])
         
     except Exception as e:
         print(f"Error procesando el archivo: {e}")
@@ -595,13 +2882,301 @@ def procesar_excel(archivo_excel):
             conn.rollback()
     
     finally:
+        if pool:
+            pool.closeall()
         if conn:
             conn.close()
 
+def listar_archivos(ruta):
+    """Devuelve los archivos de un directorio (Excel, CSV o Parquet) o de un patrón glob"""
+    if os.path.isdir(ruta):
+        archivos = [archivo for archivo in glob.glob(os.path.join(ruta, '*'))
+                    if os.path.splitext(archivo)[1].lower() in EXTENSIONES]
+    else:
+        archivos = glob.glob(ruta)
+    return sorted(archivo for archivo in archivos if not os.path.basename(archivo).startswith('~$'))
+
+def cargar_con_pool(pool, archivo_excel, df, config, intentos=3):
+    """Carga un archivo ya leído con una conexión del pool, reintentando si hubo un deadlock"""
+    for intento in range(1, intentos + 1):
+        conn = pool.getconn()
+        try:
+            resumen = cargar_archivo(conn, archivo_excel, config, df)
+            conn.commit()
+            if resumen:
+                CACHE_CONSULTAS.invalidar(resumen['fecha_min'], resumen['fecha_max'])
+            return resumen
+        except psycopg2.extensions.TransactionRollbackError:
+            conn.rollback()
+            if intento == intentos:
+                raise
+            print(f"Conflicto de bloqueo cargando {archivo_excel}, reintento {intento}...")
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            pool.putconn(conn)
+
+def cargar_en_paralelo(pool, archivos, resultados, config):
+    """Lee los archivos en un pool de procesos y los carga con las conexiones del pool
+    
+    A lo sumo 2 * conexiones_carga archivos están en curso a la vez (leyéndose, leídos o
+    cargándose): el siguiente se manda a leer cuando otro termina, así los DataFrames en
+    memoria no crecen con la cantidad de archivos del directorio.
+    """
+    conexiones = config['conexiones_carga']
+    limite = 2 * conexiones
+    archivos = iter(archivos)
+    with ProcessPoolExecutor(config['procesos_lectura']) as lectores, ThreadPoolExecutor(conexiones) as cargadores:
+        lecturas = {}
+        cargas = {}
+        
+        def completar_ventana():
+            while len(lecturas) + len(cargas) < limite and (archivo := next(archivos, None)) is not None:
+                lecturas[lectores.submit(leer_archivo_cacheado, archivo, config)] = archivo
+        
+        completar_ventana()
+        while lecturas or cargas:
+            terminadas, _ = wait([*lecturas, *cargas], return_when=FIRST_COMPLETED)
+            for tarea in terminadas:
+                if tarea in lecturas:
+                    archivo = lecturas.pop(tarea)
+                    try:
+                        df = tarea.result()
+                    except Exception as e:
+                        resultados[archivo].update(estado='error de lectura', error=str(e))
+                        continue
+                    cargas[cargadores.submit(cargar_con_pool, pool, archivo, df, config)] = archivo
+                    continue
+                
+                archivo = cargas.pop(tarea)
+                try:
+                    resumen = tarea.result()
+                    resultados[archivo].update(estado='cargado' if resumen else 'sin cambios',
+                                               filas=resumen['filas'] if resumen else 0,
+                                               fecha_min=resumen['fecha_min'] if resumen else None,
+                                               fecha_max=resumen['fecha_max'] if resumen else None)
+                except Exception as e:
+                    resultados[archivo].update(estado='error de carga', error=str(e))
+            completar_ventana()
+
+def procesar_directorio(ruta, **opciones):
+    """Procesa todos los archivos de un directorio o patrón glob
+    
+    Los archivos se leen y normalizan en un pool de procesos y se cargan en paralelo
+    con un pool acotado de conexiones. Devuelve el resultado de cada archivo.
+    """
+    config = {**CARGA_CONFIG, **opciones}
+    
+    # Cada archivo vaciaría los meses que los otros archivos del directorio acaban de cargar
+    if config['reemplazar_meses']:
+        raise ValueError("reemplazar_meses no está soportado al procesar un directorio; use procesar_excel por archivo")
+    
+    archivos = listar_archivos(ruta)
+    if not archivos:
+        print(f"No se encontraron archivos en {ruta}")
+        return []
+    
+    conexiones = config['conexiones_carga']
+    # Una conexión extra queda reservada para crear tablas y la carga masiva
+    pool = psycopg2.pool.ThreadedConnectionPool(1, conexiones + 1, connection_factory=ConexionInstrumentada, **DB_CONFIG)
+    resultados = {archivo: {'archivo': archivo, 'estado': 'pendiente', 'filas': 0, 'error': None}
+                  for archivo in archivos}
+    inicio = time.perf_counter()
+    
+    try:
+        conn = pool.getconn()
+        try:
+            crear_tablas(conn, config['particionado'], config['indice_fecha'], config['tipos_compactos'])
+            
+            # En modo incremental los archivos sin cambios no se leen
+            if config['incremental']:
+                for archivo in archivos:
+                    if archivo_en_manifiesto(conn, hash_archivo(archivo)):
+                        resultados[archivo]['estado'] = 'sin cambios'
+            
+            pendientes_lectura = [archivo for archivo in archivos if resultados[archivo]['estado'] == 'pendiente']
+            print(f"Procesando {len(pendientes_lectura)} archivos con {config['procesos_lectura'] or os.cpu_count()} "
+                  f"procesos de lectura y {conexiones} conexiones...")
+            
+            # La carga masiva abarca el directorio completo: índices y FKs se reconstruyen una sola vez
+            masiva = usar_carga_masiva(config, sum(contar_filas(archivo, config) for archivo in pendientes_lectura))
+            with carga_masiva(conn, masiva):
+                cargar_en_paralelo(pool, pendientes_lectura, resultados, config)
+            
+            # El espejo se rehace una vez, con la unión de los meses de los archivos cargados
+            if config['dir_espejo']:
+                meses = [mes for resultado in resultados.values() if resultado.get('fecha_min')
+                         for mes in meses_en_rango(resultado['fecha_min'], resultado['fecha_max'])]
+                if meses:
+                    try:
+                        exportar_espejo(conn, meses, config['dir_espejo'])
+                    except Exception as e:
+                        print(f"Advertencia: No se pudo actualizar el espejo Parquet: {e}")
+        finally:
+            pool.putconn(conn)
+    finally:
+        pool.closeall()
+    
+    print(f"\n=== RESUMEN ({time.perf_counter() - inicio:.1f}s) ===")
+    for resultado in resultados.values():
+        detalle = f" - {resultado['error']}" if resultado['error'] else ''
+        print(f"{os.path.basename(resultado['archivo'])}: {resultado['estado']} ({resultado['filas']} filas){detalle}")
+    
+    return list(resultados.values())
+
+class CacheConsultas:
+    """Caché LRU con TTL de resultados de consultas, indexada por el rango de fechas que cubren
+    
+    Cada resultado guarda la versión de sus meses en carga_versiones: si una carga de
+    cualquier proceso la cambió, el resultado ya no se devuelve.
+    """
+    
+    def __init__(self, max_entradas=256, ttl=300):
+        self.max_entradas = max_entradas
+        self.ttl = ttl
+        self.entradas = OrderedDict()
+        self.aciertos = 0
+        self.fallos = 0
+        self._lock = threading.Lock()
+    
+    def obtener(self, clave, version=None):
+        """Devuelve una copia del resultado guardado, o None si no está, expiró o su versión cambió"""
+        with self._lock:
+            entrada = self.entradas.get(clave)
+            if entrada is None or entrada['expira'] < time.monotonic() or entrada['version'] != version:
+                self.entradas.pop(clave, None)
+                self.fallos += 1
+                return None
+            self.entradas.move_to_end(clave)
+            self.aciertos += 1
+            return entrada['resultado'].copy()
+    
+    def guardar(self, clave, resultado, desde=None, hasta=None, version=None):
+        """Guarda un resultado; desde/hasta None significa que depende de todas las fechas"""
+        with self._lock:
+            self.entradas[clave] = {'resultado': resultado.copy(), 'desde': desde, 'hasta': hasta,
+                                    'version': version, 'expira': time.monotonic() + self.ttl}
+            self.entradas.move_to_end(clave)
+            while len(self.entradas) > self.max_entradas:
+                self.entradas.popitem(last=False)
+    
+    def invalidar(self, fecha_min=None, fecha_max=None):
+        """Descarta los resultados que cubren algún mes del rango cargado (sin rango, todos)"""
+        with self._lock:
+            if fecha_min is None or fecha_max is None:
+                descartadas = list(self.entradas)
+            else:
+                # Se amplía a meses completos: los resúmenes y el reemplazo de meses trabajan por mes
+                desde = pd.Timestamp(fecha_min).replace(day=1).date()
+                hasta = (pd.Timestamp(fecha_max) + pd.offsets.MonthEnd(0)).date()
+                descartadas = [clave for clave, entrada in self.entradas.items()
+                               if (entrada['desde'] is None or entrada['desde'] <= hasta)
+                               and (entrada['hasta'] is None or entrada['hasta'] >= desde)]
+            for clave in descartadas:
+                del self.entradas[clave]
+        if descartadas:
+            print(f"Caché de consultas: {len(descartadas)} resultados invalidados")
+
+CACHE_CONSULTAS = CacheConsultas(CARGA_CONFIG['consultas_cache_max'], CARGA_CONFIG['consultas_cache_ttl'])
+_pool_consultas = None
+_lock_pool_consultas = threading.Lock()
+
+def pool_consultas():
+    """Pool de conexiones compartido por las consultas de reporte (se crea al primer uso)"""
+    global _pool_consultas
+    with _lock_pool_consultas:
+        if _pool_consultas is None:
+            _pool_consultas = psycopg2.pool.ThreadedConnectionPool(
+                1, CARGA_CONFIG['consultas_conexiones'], connection_factory=ConexionInstrumentada, **DB_CONFIG)
+        return _pool_consultas
+
+def a_fecha(valor):
+    """Convierte una fecha en texto, datetime o date a date"""
+    return pd.Timestamp(valor).date() if valor is not None else None
+
+def consultar(sql, parametros=(), desde=None, hasta=None):
+    """Ejecuta una consulta de solo lectura y devuelve un DataFrame, usando la caché de consultas
+    
+    desde/hasta indican las fechas de las que depende el resultado, para invalidarlo
+    cuando una carga (de este u otro proceso) toca esas fechas.
+    """
+    clave = (sql, tuple(parametros))
+    pool = pool_consultas()
+    conn = pool.getconn()
+    try:
+        cursor = conn.cursor()
+        try:
+            # La versión se lee antes que los datos: una carga entre ambas lecturas invalida el resultado
+            version = version_meses(cursor, desde, hasta)
+            resultado = CACHE_CONSULTAS.obtener(clave, version)
+            if resultado is None:
+                cursor.execute(sql, parametros)
+                resultado = pd.DataFrame(cursor.fetchall(), columns=[columna[0] for columna in cursor.description])
+                CACHE_CONSULTAS.guardar(clave, resultado, desde, hasta, version)
+        finally:
+            cursor.close()
+        conn.rollback()
+    finally:
+        pool.putconn(conn)
+    
+    return resultado
+
+def top_productos(fecha_desde, fecha_hasta, n=10):
+    """Productos con mayor merma_monto en un período"""
+    desde, hasta = a_fecha(fecha_desde), a_fecha(fecha_hasta)
+    return consultar("""
+    SELECT p.codigo_producto, p.nombre_producto, c.nombre_categoria,
+           SUM(m.merma_monto) AS merma_monto, SUM(m.merma_unidad) AS merma_unidad
+    FROM mermas m
+    JOIN producto p ON p.codigo_producto = m.codigo_producto
+    LEFT JOIN categoria c ON c.id_categoria = p.id_categoria
+    WHERE m.fecha BETWEEN %s AND %s
+    GROUP BY p.codigo_producto, p.nombre_producto, c.nombre_categoria
+    ORDER BY merma_monto DESC
+    LIMIT %s
+    """, (desde, hasta, n), desde, hasta)
+
+def mermas_por_region_mes(fecha_desde, fecha_hasta):
+    """Merma por región y mes, leída desde la tabla resumen"""
+    desde, hasta = a_fecha(fecha_desde), a_fecha(fecha_hasta)
+    return consultar("""
+    SELECT añomes, nombre_region, SUM(merma_monto) AS merma_monto, SUM(merma_unidad) AS merma_unidad
+    FROM resumen_mermas_region
+    WHERE añomes BETWEEN %s AND %s
+    GROUP BY añomes, nombre_region
+    ORDER BY añomes, nombre_region
+    """, (desde.strftime('%Y-%m'), hasta.strftime('%Y-%m')), desde, hasta)
+
+def tendencia_tienda(tienda, fecha_desde, fecha_hasta):
+    """Merma diaria de una tienda en un período"""
+    desde, hasta = a_fecha(fecha_desde), a_fecha(fecha_hasta)
+    return consultar("""
+    SELECT m.fecha, SUM(m.merma_monto) AS merma_monto, SUM(m.merma_unidad) AS merma_unidad
+    FROM mermas m
+    JOIN ubicacion u ON u.id_ubicacion = m.id_comuna
+    WHERE u.tienda = %s AND m.fecha BETWEEN %s AND %s
+    GROUP BY m.fecha
+    ORDER BY m.fecha
+    """, (normalizar_valor(tienda), desde, hasta), desde, hasta)
+
 # Función para solo diagnosticar sin procesar
-def solo_diagnosticar(archivo_excel):
-    """Solo diagnostica el archivo sin procesar los datos"""
-    return diagnosticar_excel(archivo_excel)
+def solo_diagnosticar(archivo_excel, rapido=True):
+    """Solo diagnostica el archivo sin procesar los datos
+    
+    En modo rápido se perfila una muestra de filas (CARGA_CONFIG['perfil_muestra']) en
+    lugar de leer el archivo completo.
+    """
+    if not rapido:
+        return diagnosticar_excel(archivo_excel)
+    
+    try:
+        perfil = perfilar_archivo(archivo_excel, CARGA_CONFIG['perfil_muestra'])
+    except Exception as e:
+        print(f"Error leyendo el archivo: {e}")
+        return None
+    imprimir_perfil(perfil)
+    return perfil
 
 # Uso del script
 if __name__ == "__main__":